@@ -1,9 +1,30 @@
 from django.contrib import admin
+from django.db import transaction
+from processpay.ledger import payment_state, record_payment_changes
+from processpay.models import Payment
 from .models import Invoice
+from .forms import InvoiceForm
 
 class InvoiceAdmin(admin.ModelAdmin):
+    form = InvoiceForm
     list_display = ('name', 'start_date', 'end_date', 'monthly_amount', 'created_at')
     list_filter = ('start_date', 'end_date')
     search_fields = ('name',)
 
+    # Keep the payment totals in step with edits made here
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            form.record_amount_change()
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, Invoice.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        # Payments go with their invoice (CASCADE)
+        with transaction.atomic():
+            payments = Payment.objects.filter(invoice__in=queryset)
+            record_payment_changes((payment_state(p), None) for p in payments)
+            super().delete_queryset(request, queryset)
+
 admin.site.register(Invoice, InvoiceAdmin)
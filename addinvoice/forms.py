@@ -1,5 +1,7 @@
 from django import forms
+from django.db import transaction
 from .models import Invoice
+from processpay.ledger import record_monthly_amount_change
 
 class InvoiceForm(forms.ModelForm):
     class Meta:
@@ -8,4 +10,21 @@ class InvoiceForm(forms.ModelForm):
         widgets = {
             'start_date': forms.DateInput(attrs={'type': 'date'}),
             'end_date': forms.DateInput(attrs={'type': 'date'}),
-        }
\ No newline at end of file
+        }
+
+    def save(self, commit=True):
+        # Changing the billing window invalidates the generation watermark,
+        # so the next run re-expands the schedule from the start date
+        if {'start_date', 'end_date'} & set(self.changed_data):
+            self.instance.generated_through = None
+        with transaction.atomic():
+            invoice = super().save(commit)
+            if commit:
+                self.record_amount_change()
+        return invoice
+
+    def record_amount_change(self):
+        """Move the monthly summary's due amounts to an edited monthly amount"""
+        old_amount = self.initial.get('monthly_amount')
+        if old_amount is not None and 'monthly_amount' in self.changed_data:
+            record_monthly_amount_change(self.instance, old_amount)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 02:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('addinvoice', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='generated_through',
+            field=models.DateField(blank=True, editable=False, null=True, verbose_name='已生成至'),
+        ),
+    ]
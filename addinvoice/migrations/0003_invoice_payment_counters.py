@@ -0,0 +1,59 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:16
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_counters(apps, schema_editor):
+    """Same computation as processpay.ledger.rebuild_invoice_counters"""
+    Invoice = apps.get_model('addinvoice', 'Invoice')
+    Payment = apps.get_model('processpay', 'Payment')
+    payments = Payment.objects.filter(invoice=OuterRef('pk')).order_by().values('invoice')
+
+    def aggregate(expression, output_field, **filters):
+        return Coalesce(
+            Subquery(payments.filter(**filters).annotate(value=expression).values('value'), output_field=output_field),
+            Value(0),
+            output_field=output_field,
+        )
+
+    decimal = models.DecimalField(max_digits=12, decimal_places=2)
+    Invoice.objects.update(
+        processed_count=aggregate(Count('id'), models.IntegerField(), processed=True),
+        received_total=aggregate(Sum('amount_received'), decimal, processed=True, is_deducted=False),
+        deducted_total=aggregate(Sum('amount_received'), decimal, is_deducted=True),
+        pending_count=aggregate(Count('id'), models.IntegerField(), processed=False),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('addinvoice', '0002_invoice_generated_through'),
+        ('processpay', '0004_payment_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='deducted_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='扣款總額'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='pending_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='待處理期數'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='processed_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='已處理期數'),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='received_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='實收總額'),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
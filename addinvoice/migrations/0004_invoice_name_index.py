@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 05:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('addinvoice', '0003_invoice_payment_counters'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invoice',
+            name='name',
+            field=models.CharField(db_index=True, max_length=200, verbose_name='單名稱'),
+        ),
+    ]
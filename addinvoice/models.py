@@ -2,13 +2,21 @@ from django.db import models
 from django.utils import timezone
 
 class Invoice(models.Model):
-    name = models.CharField(max_length=200, verbose_name="單名稱")
+    # Indexed for the pending payments filter and the CSV import lookups by name
+    name = models.CharField(max_length=200, db_index=True, verbose_name="單名稱")
     start_date = models.DateField(verbose_name="開始日期")
     end_date = models.DateField(verbose_name="結束日期")
     monthly_amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="每月應收金額")
     deduction_recipient = models.CharField(max_length=100, blank=True, null=True, verbose_name="轉帳對象")
     deduction_periods = models.IntegerField(default=0, verbose_name="扣款期數")
     created_at = models.DateTimeField(default=timezone.now, verbose_name="創建時間")
+    # First day of the last month already expanded into Payment rows
+    generated_through = models.DateField(null=True, blank=True, editable=False, verbose_name="已生成至")
+    # Payment counters kept up to date by processpay.ledger
+    processed_count = models.IntegerField(default=0, editable=False, verbose_name="已處理期數")
+    received_total = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False, verbose_name="實收總額")
+    deducted_total = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False, verbose_name="扣款總額")
+    pending_count = models.IntegerField(default=0, editable=False, verbose_name="待處理期數")
 
     def __str__(self):
         return self.name
@@ -0,0 +1,96 @@
+"""
+Per-request database query accounting.
+
+``QueryBudgetMiddleware`` installs a ``connection.execute_wrapper`` hook for
+the duration of each request and logs the query count, the total database
+time and the slowest statements as one JSON line through the
+``plantcon.queries`` logger. The line is logged at DEBUG, so production
+(which logs ``plantcon`` at INFO) only records it when a view with a budget
+in QUERY_BUDGETS runs more queries than that: those requests are logged as
+a warning, or raise QueryBudgetExceeded when QUERY_BUDGET_STRICT is set (as
+the view tests do).
+
+Queries run while a streaming response is consumed happen after the
+middleware returns and are not counted.
+"""
+import heapq
+import json
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('plantcon.queries')
+
+SQL_LOG_LENGTH = 500
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryRecorder:
+    """``execute_wrapper`` hook that counts and times every statement"""
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.count = 0
+        self.total = 0.0
+        self.slowest = []  # min-heap of (duration, order, sql)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.total += duration
+            entry = (duration, self.count, sql)
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def slowest_statements(self):
+        return [
+            {'sql': sql[:SQL_LOG_LENGTH], 'ms': round(duration * 1000, 2)}
+            for duration, _, sql in sorted(self.slowest, reverse=True)
+        ]
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder(settings.QUERY_LOG_SLOWEST)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            # Wrapping does not open a connection; that waits for the first query
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+
+        match = request.resolver_match
+        view = match.view_name if match else None
+        budget = settings.QUERY_BUDGETS.get(view)
+        record = {
+            'event': 'request_queries',
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'queries': recorder.count,
+            'db_ms': round(recorder.total * 1000, 2),
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+            'budget': budget,
+            'slowest': recorder.slowest_statements(),
+        }
+        over_budget = budget is not None and recorder.count > budget
+        logger.log(logging.WARNING if over_budget else logging.DEBUG, json.dumps(record))
+        if over_budget and settings.QUERY_BUDGET_STRICT:
+            raise QueryBudgetExceeded(f'{view} ran {recorder.count} queries, over its budget of {budget}')
+        return response
@@ -4,6 +4,7 @@ Base Django settings for plantcon project.
 
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -31,6 +32,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # For static files in production
+    'plantcon.middleware.QueryBudgetMiddleware',  # Logs the queries of each request
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -95,12 +97,73 @@ STATICFILES_DIRS = [
     BASE_DIR / 'plantcon/static',
 ]
 
+# Uploaded files (queued CSV imports)
+MEDIA_URL = 'media/'
+MEDIA_ROOT = Path(os.getenv('MEDIA_ROOT', BASE_DIR / 'media'))
+
 # Use WhiteNoise for static files
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# The ledger versions in statement/cache.py must be seen by every web, scheduler
+# and worker process, so the cache is shared through the database (run
+# `createcachetable` once); production switches to Redis when REDIS_ENDPOINT is set
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'plantcon_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 10000)),
+        },
+    }
+}
+
+# Dashboard data is cached per ledger version (statement/cache.py)
+DASHBOARD_CACHE_TIMEOUT = int(os.getenv('DASHBOARD_CACHE_TIMEOUT', 300))
+# Invoice history pages are cached per invoice version in the same way
+INVOICE_HISTORY_CACHE_TIMEOUT = int(os.getenv('INVOICE_HISTORY_CACHE_TIMEOUT', 300))
+
+# Background jobs (see processpay/locks.py)
+# Lock files are only used when the database has no advisory locks (SQLite)
+JOB_LOCK_DIR = os.getenv('JOB_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'plantcon-locks'))
+
+# Pending payments list and invoice history, paginated by (due_date, id) (processpay/pagination.py)
+PENDING_PAYMENTS_PAGE_SIZE = int(os.getenv('PENDING_PAYMENTS_PAGE_SIZE', 50))
+INVOICE_PAYMENTS_PAGE_SIZE = int(os.getenv('INVOICE_PAYMENTS_PAGE_SIZE', 24))
+
+# Payment CSV import
+# Uploads are streamed from disk in batches, so the limit is not bound by memory
+PAYMENT_IMPORT_MAX_UPLOAD_SIZE = int(os.getenv('PAYMENT_IMPORT_MAX_UPLOAD_SIZE', 100 * 1024 * 1024))  # 100MB
+PAYMENT_IMPORT_BATCH_SIZE = int(os.getenv('PAYMENT_IMPORT_BATCH_SIZE', 1000))
+# How long an import preview can be applied without uploading the file again
+PAYMENT_IMPORT_PREVIEW_TIMEOUT = int(os.getenv('PAYMENT_IMPORT_PREVIEW_TIMEOUT', 60 * 60))
+# A running import that has not finished a batch for this many seconds is failed
+IMPORT_JOB_STALE_AFTER = int(os.getenv('IMPORT_JOB_STALE_AFTER', 30 * 60))
+# Use COPY for CSV export/import on PostgreSQL (statement/pgcopy.py)
+PAYMENT_CSV_USE_COPY = os.getenv('PAYMENT_CSV_USE_COPY', 'True') == 'True'
+
+# Query accounting (plantcon/middleware.py)
+# Maximum queries per request for a view name; views not listed are only logged
+QUERY_BUDGETS = {
+    # Counts include the database cache's own queries; a ledger change writes
+    # up to INVOICE_BUMP_LIMIT + 1 version keys and a first read creates them
+    # (statement/cache.py)
+    'processpay:pending_payments': 5,
+    'processpay:process_payment': 22,
+    'processpay:bulk_process_payments': 28,
+    'statement:dashboard': 20,
+    'statement:invoice_detail': 26,
+    'statement:toggle_deducted': 23,
+    'statement:bulk_toggle_deducted': 33,
+    'statement:import_job_status': 4,
+}
+# Raise QueryBudgetExceeded instead of logging a warning (used by the view tests)
+QUERY_BUDGET_STRICT = os.getenv('QUERY_BUDGET_STRICT', 'False') == 'True'
+# Number of slowest statements included in each request's log line
+QUERY_LOG_SLOWEST = int(os.getenv('QUERY_LOG_SLOWEST', 3))
+
 # Security settings (will be overridden in production)
 SECURE_SSL_REDIRECT = False
 SECURE_HSTS_SECONDS = 0
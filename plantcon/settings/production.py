@@ -88,9 +88,6 @@ if os.getenv('REDIS_ENDPOINT'):
         'default': {
             'BACKEND': 'django.core.cache.backends.redis.RedisCache',
             'LOCATION': f"redis://{os.getenv('REDIS_ENDPOINT')}:6379/1",
-            'OPTIONS': {
-                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
-            }
         }
     }
 
@@ -98,5 +95,7 @@ if os.getenv('REDIS_ENDPOINT'):
 SECURE_REFERRER_POLICY = 'strict-origin-when-cross-origin'
 
 # File upload settings
+# Uploads above FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to a temporary file;
+# the CSV import size limit is PAYMENT_IMPORT_MAX_UPLOAD_SIZE
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
-DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
\ No newline at end of file
+DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB, excludes file contents
\ No newline at end of file
@@ -1,4 +1,6 @@
 from django.contrib import admin
+from django.db import transaction
+from .ledger import payment_state, record_payment_changes
 from .models import Payment
 
 class PaymentAdmin(admin.ModelAdmin):
@@ -6,4 +8,21 @@ class PaymentAdmin(admin.ModelAdmin):
     list_filter = ('processed', 'due_date')
     search_fields = ('invoice__name',)
 
+    # Keep the invoice counters in step with edits made here
+    def save_model(self, request, obj, form, change):
+        before = payment_state(Payment.objects.get(pk=obj.pk)) if change else None
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            record_payment_changes([(before, payment_state(obj))])
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            record_payment_changes([(payment_state(obj), None)])
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            record_payment_changes((payment_state(p), None) for p in queryset)
+            super().delete_queryset(request, queryset)
+
 admin.site.register(Payment, PaymentAdmin)
@@ -0,0 +1,27 @@
+from django import forms
+from .months import month_start, next_month
+
+
+class MonthInput(forms.DateInput):
+    input_type = 'month'
+
+    def __init__(self, attrs=None):
+        super().__init__(attrs, format='%Y-%m')
+
+
+class PendingPaymentFilterForm(forms.Form):
+    """Filters of the pending payments list; invalid values are ignored"""
+    invoice = forms.CharField(required=False, label='Invoice')
+    from_month = forms.DateField(required=False, input_formats=['%Y-%m'], widget=MonthInput, label='From')
+    to_month = forms.DateField(required=False, input_formats=['%Y-%m'], widget=MonthInput, label='To')
+
+    def filter(self, payments):
+        self.is_valid()
+        filters = self.cleaned_data
+        if filters.get('invoice'):
+            payments = payments.filter(invoice__name=filters['invoice'])
+        if filters.get('from_month'):
+            payments = payments.filter(due_date__gte=month_start(filters['from_month']))
+        if filters.get('to_month'):
+            payments = payments.filter(due_date__lt=next_month(month_start(filters['to_month'])))
+        return payments
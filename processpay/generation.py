@@ -0,0 +1,146 @@
+"""
+Bulk engine that creates the monthly Payment rows owed by each invoice.
+
+Run by the ``generate_payments`` management command, normally as the
+``--loop`` scheduler.
+"""
+import time
+from dataclasses import dataclass
+from itertools import islice
+
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from addinvoice.models import Invoice
+from statement.cache import bump_ledger_version
+from .ledger import add_to_counters, add_to_summary
+from .models import Payment
+from .months import days_in_month, month_start, next_month
+
+BATCH_SIZE = 1000
+
+
+@dataclass
+class GenerationResult:
+    """Outcome of a generation run"""
+    created: int
+    elapsed: float
+
+
+def _due_months(invoice, today):
+    """
+    Yield the first day of every month owed by ``invoice`` up to ``today``.
+
+    A month becomes due once the invoice's start day has been reached in that
+    month (clamped to the month length, so a start on the 31st still bills
+    in February). Months up to the invoice's ``generated_through`` watermark
+    are skipped.
+    """
+    last_date = min(today, invoice.end_date) if invoice.end_date else today
+    start_day = invoice.start_date.day
+    month = month_start(invoice.start_date)
+    if invoice.generated_through and invoice.generated_through >= month:
+        month = next_month(invoice.generated_through)
+    while month <= last_date:
+        if month.replace(day=min(start_day, days_in_month(month))) > last_date:
+            break
+        yield month
+        month = next_month(month)
+
+
+def _watermark(invoice, today, last_due_month):
+    """Return the month the invoice has been fully expanded through"""
+    if invoice.end_date and invoice.end_date <= today:
+        # Nothing after the end month can ever become due
+        return month_start(invoice.end_date)
+    return last_due_month or invoice.generated_through
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _insert_missing(payments):
+    """
+    Insert ``payments`` with one ``INSERT ... ON CONFLICT DO NOTHING``, so
+    months that already exist are dropped by the unique constraint, and
+    return the ``(invoice_id, due_month)`` of the rows actually inserted.
+    """
+    db = connections[router.db_for_write(Payment)]
+    quote = db.ops.quote_name
+    fields = [field for field in Payment._meta.concrete_fields if not field.primary_key]
+    row = '({})'.format(', '.join(['%s'] * len(fields)))
+    sql = 'INSERT INTO {} ({}) VALUES {} ON CONFLICT DO NOTHING RETURNING {}, {}'.format(
+        quote(Payment._meta.db_table),
+        ', '.join(quote(field.column) for field in fields),
+        ', '.join([row] * len(payments)),
+        quote(Payment._meta.get_field('invoice').column),
+        quote(Payment._meta.get_field('due_month').column),
+    )
+    params = [field.get_db_prep_save(getattr(payment, field.attname), db) for payment in payments for field in fields]
+    with db.cursor() as cursor:
+        cursor.execute(sql, params)
+        inserted = cursor.fetchall()
+    to_month = Payment._meta.get_field('due_month').to_python
+    return [(invoice_id, to_month(month)) for invoice_id, month in inserted]
+
+
+def generate_pending_payments(today=None, batch_size=BATCH_SIZE):
+    """
+    Create every missing monthly payment for active invoices.
+
+    Only months after each invoice's ``generated_through`` watermark are
+    considered, so a run costs time proportional to the new months rather
+    than the whole history. Rows are written with conflict-ignoring
+    inserts; the (invoice, due_month) unique constraint drops months that
+    already exist, so concurrent runs cannot duplicate them, and only the
+    rows an insert reports back are added to the ledger.
+    """
+    started = time.monotonic()
+    today = today or timezone.now().date()
+    this_month = month_start(today)
+
+    candidates = Invoice.objects.filter(start_date__lte=today).filter(
+        Q(generated_through__isnull=True)
+        | Q(generated_through__lt=this_month) & Q(generated_through__lt=TruncMonth('end_date'))
+    )
+    invoices = list(candidates.only('id', 'start_date', 'end_date', 'generated_through', 'monthly_amount'))
+    monthly_amounts = {invoice.id: invoice.monthly_amount for invoice in invoices}
+
+    advanced = []
+
+    def new_payments():
+        for invoice in invoices:
+            last_due_month = None
+            for month in _due_months(invoice, today):
+                last_due_month = month
+                yield Payment(invoice_id=invoice.id, due_date=month, due_month=month, processed=False)
+            watermark = _watermark(invoice, today, last_due_month)
+            if watermark != invoice.generated_through:
+                invoice.generated_through = watermark
+                advanced.append(invoice)
+
+    with transaction.atomic():
+        # Only the new rows are counted: existing rows, including ones moved
+        # into a month concurrently, are recorded by whoever changed them.
+        created, months = {}, {}
+        inserted = (key for batch in _batched(new_payments(), batch_size) for key in _insert_missing(batch))
+        for invoice_id, month in inserted:
+            amount = monthly_amounts[invoice_id]
+            created[invoice_id] = created.get(invoice_id, 0) + 1
+            totals = months.setdefault(month, {'payment_count': 0, 'pending_count': 0, 'due_amount': 0, 'pending_amount': 0})
+            totals['payment_count'] += 1
+            totals['pending_count'] += 1
+            totals['due_amount'] += amount
+            totals['pending_amount'] += amount
+        add_to_counters({invoice_id: {'pending_count': count} for invoice_id, count in created.items()})
+        add_to_summary(months)
+        Invoice.objects.bulk_update(advanced, ['generated_through'], batch_size=batch_size)
+        if created:
+            bump_ledger_version(created)
+
+    return GenerationResult(created=sum(created.values()), elapsed=time.monotonic() - started)
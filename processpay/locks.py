@@ -0,0 +1,62 @@
+"""
+Cross-process locks for background jobs.
+
+PostgreSQL session advisory locks are used when available so that only one
+container runs a job at a time. Other backends (SQLite in local setups) fall
+back to an exclusive ``flock`` on a shared lock file.
+"""
+import fcntl
+import os
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+
+def _advisory_key(name):
+    """Map a lock name onto the signed 32-bit key space of pg advisory locks"""
+    return zlib.crc32(name.encode('utf-8')) - 2**31
+
+
+@contextmanager
+def _advisory_lock(name):
+    key = _advisory_key(name)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [key])
+        acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [key])
+
+
+@contextmanager
+def _file_lock(name):
+    lock_dir = settings.JOB_LOCK_DIR
+    os.makedirs(lock_dir, exist_ok=True)
+    path = os.path.join(lock_dir, f'{name}.lock')
+    with open(path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def job_lock(name):
+    """
+    Try to take the named job lock without blocking.
+
+    Used as a context manager yielding ``True`` when this process holds the
+    lock and ``False`` when another process already does.
+    """
+    if connection.vendor == 'postgresql':
+        return _advisory_lock(name)
+    return _file_lock(name)
@@ -1,36 +1,43 @@
+import time
+
 from django.core.management.base import BaseCommand
-from addinvoice.models import Invoice
-from processpay.models import Payment
-from django.utils import timezone
-import datetime
+from django.db import close_old_connections
+from processpay.generation import BATCH_SIZE, generate_pending_payments
+from processpay.locks import job_lock
+
+LOCK_NAME = 'generate_payments'
 
 class Command(BaseCommand):
     help = 'Generates monthly payments for active invoices, including past due ones.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Number of payments inserted per INSERT statement.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and generate payments every --interval seconds.')
+        parser.add_argument('--interval', type=int, default=300,
+                            help='Seconds to sleep between runs in --loop mode.')
+
     def handle(self, *args, **options):
-        today = timezone.now().date()
-        invoices = Invoice.objects.filter(start_date__lte=today)
+        if not options['loop']:
+            self._run_once(options['batch_size'])
+            return
 
-        for invoice in invoices:
-            # Determine the date range to check for payments
-            start_month = invoice.start_date
-            end_month = min(today, invoice.end_date)
+        while True:
+            close_old_connections()
+            try:
+                self._run_once(options['batch_size'])
+            except Exception as e:
+                # Keep the scheduler alive; the next tick will retry
+                self.stderr.write(self.style.ERROR(f'Payment generation failed: {e}'))
+            time.sleep(options['interval'])
 
-            current_month = start_month
-            while current_month <= end_month:
-                # Check if a payment for this month already exists
-                if not Payment.objects.filter(invoice=invoice, due_date__year=current_month.year, due_date__month=current_month.month).exists():
-                    due_date = current_month.replace(day=1)
-                    Payment.objects.create(
-                        invoice=invoice,
-                        due_date=due_date,
-                        processed=False
-                    )
-                    self.stdout.write(self.style.SUCCESS(f'Created payment for {invoice.name} for {due_date.strftime("%Y-%m")}'))
-                
-                # Move to the next month
-                # A simple way to advance the month
-                if current_month.month == 12:
-                    current_month = current_month.replace(year=current_month.year + 1, month=1)
-                else:
-                    current_month = current_month.replace(month=current_month.month + 1)
\ No newline at end of file
+    def _run_once(self, batch_size):
+        with job_lock(LOCK_NAME) as acquired:
+            if not acquired:
+                self.stdout.write('Another process is generating payments, skipping this run.')
+                return
+            result = generate_pending_payments(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {result.created} payments in {result.elapsed:.2f}s'
+        ))
@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+from processpay.ledger import rebuild_invoice_counters
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the per-invoice payment counters (processed, received, deducted, pending) from the payments.'
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        updated = rebuild_invoice_counters()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt counters for {updated} invoices in {time.monotonic() - started:.2f}s.'
+        ))
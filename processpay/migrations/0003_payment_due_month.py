@@ -0,0 +1,69 @@
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncMonth
+
+
+def populate_due_month(apps, schema_editor):
+    Payment = apps.get_model('processpay', 'Payment')
+    Payment.objects.update(due_month=TruncMonth('due_date'))
+
+
+def remove_duplicate_months(apps, schema_editor):
+    """
+    Keep one payment per (invoice, month). Only unprocessed duplicates are
+    deleted; a processed payment is kept, or the oldest row when none is
+    processed. Months with several processed payments stop the migration,
+    since removing any of them would lose a payment record.
+    """
+    Payment = apps.get_model('processpay', 'Payment')
+    duplicates = (
+        Payment.objects.values('invoice_id', 'due_month')
+        .annotate(rows=Count('id'))
+        .filter(rows__gt=1)
+        .order_by()
+    )
+    conflicts = []
+    redundant = []
+    for group in duplicates.iterator():
+        rows = list(
+            Payment.objects.filter(invoice_id=group['invoice_id'], due_month=group['due_month'])
+            .order_by('-processed', 'id')
+            .values_list('id', 'processed')
+        )
+        processed = [pk for pk, is_processed in rows if is_processed]
+        if len(processed) > 1:
+            conflicts.append(f"invoice {group['invoice_id']} {group['due_month']:%Y-%m}: payments {processed}")
+        redundant.extend(pk for pk, is_processed in rows[1:] if not is_processed)
+
+    if conflicts:
+        raise RuntimeError(
+            'Several processed payments share a month; merge or move them before migrating:\n  '
+            + '\n  '.join(conflicts)
+        )
+    Payment.objects.filter(id__in=redundant).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('processpay', '0002_remove_payment_payment_date_payment_due_date_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='due_month',
+            field=models.DateField(editable=False, null=True, verbose_name='應付月份'),
+        ),
+        migrations.RunPython(populate_due_month, migrations.RunPython.noop),
+        migrations.RunPython(remove_duplicate_months, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='payment',
+            name='due_month',
+            field=models.DateField(editable=False, verbose_name='應付月份'),
+        ),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(fields=('invoice', 'due_month'), name='unique_payment_per_invoice_month'),
+        ),
+    ]
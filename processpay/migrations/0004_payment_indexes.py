@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('addinvoice', '0002_invoice_generated_through'),
+        ('processpay', '0003_payment_due_month'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('processed', False)), fields=['due_date'], name='payment_pending_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['invoice', 'processed'], name='payment_invoice_processed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['invoice', 'due_date'], name='payment_invoice_due_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('addinvoice', '0003_invoice_payment_counters'),
+        ('processpay', '0004_payment_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_pending_due_idx',
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('processed', False)), fields=['due_date', 'id'], name='payment_pending_due_idx'),
+        ),
+    ]
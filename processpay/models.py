@@ -1,14 +1,38 @@
 from django.db import models
+from django.db.models import Q
 from addinvoice.models import Invoice
 from django.utils import timezone
+from .months import month_start
 
 class Payment(models.Model):
     invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, related_name='payments', verbose_name="關聯單")
     due_date = models.DateField(verbose_name="應付日期")
+    # First day of the due month; one payment per invoice per month
+    due_month = models.DateField(editable=False, verbose_name="應付月份")
     processed_date = models.DateField(null=True, blank=True, verbose_name="實際付款日期")
     amount_received = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="實收金額")
     is_deducted = models.BooleanField(default=False, verbose_name="是否已扣款轉帳")
     processed = models.BooleanField(default=False, verbose_name="已處理")
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['invoice', 'due_month'], name='unique_payment_per_invoice_month'),
+        ]
+        indexes = [
+            # Pending payments list, paginated by (due_date, id)
+            models.Index(fields=['due_date', 'id'], condition=Q(processed=False), name='payment_pending_due_idx'),
+            # Processed count per invoice (deduction periods)
+            models.Index(fields=['invoice', 'processed'], name='payment_invoice_processed_idx'),
+            # Invoice detail, ordered by due date
+            models.Index(fields=['invoice', 'due_date'], name='payment_invoice_due_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.due_month = month_start(self.due_date)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'due_date' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'due_month'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.invoice.name} - {self.due_date}"
@@ -0,0 +1,22 @@
+"""
+Month helpers shared by payment generation, the dashboard and the CSV import.
+
+A month is represented by its first day, as stored in ``Payment.due_month``.
+"""
+import calendar
+
+
+def month_start(day):
+    """Return the first day of the month containing ``day``"""
+    return day.replace(day=1)
+
+
+def next_month(month):
+    """Return the first day of the month following ``month``"""
+    if month.month == 12:
+        return month.replace(year=month.year + 1, month=1, day=1)
+    return month.replace(month=month.month + 1, day=1)
+
+
+def days_in_month(month):
+    return calendar.monthrange(month.year, month.month)[1]
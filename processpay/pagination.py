@@ -0,0 +1,44 @@
+"""
+Keyset pagination of payments ordered by ``(due_date, id)``.
+
+A page starts after the last row of the previous page instead of at an
+OFFSET, so every page is the same index range scan however deep it is.
+The cursor is the ``due_date`` and ``id`` of that last row.
+"""
+from dataclasses import dataclass
+from datetime import date
+
+from django.db.models import Q
+
+
+@dataclass
+class PaymentPage:
+    payments: list
+    next_cursor: str | None = None
+
+
+def encode_cursor(payment):
+    return f'{payment.due_date.isoformat()}.{payment.pk}'
+
+
+def decode_cursor(value):
+    """Return ``(due_date, id)`` from a cursor, or None when it is missing or invalid"""
+    try:
+        due_date, pk = value.split('.')
+        return date.fromisoformat(due_date), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def payment_page(queryset, cursor, size):
+    """Return the ``size`` payments of ``queryset`` that follow ``cursor``"""
+    queryset = queryset.order_by('due_date', 'id')
+    after = decode_cursor(cursor)
+    if after:
+        due_date, pk = after
+        # due_date >= bounds the index range; the OR only skips ties already shown
+        queryset = queryset.filter(Q(due_date__gt=due_date) | Q(id__gt=pk), due_date__gte=due_date)
+    payments = list(queryset[:size + 1])
+    if len(payments) > size:
+        return PaymentPage(payments[:size], encode_cursor(payments[size - 1]))
+    return PaymentPage(payments)
@@ -0,0 +1,181 @@
+"""
+Payment processing shared by the single and bulk processing views.
+
+``parse_amount`` holds the validation rules for an amount received.
+``process_pending_payment`` marks a payment processed with one conditional
+UPDATE, and ``process_payments`` locks the pending payments, then marks
+them processed with UPDATEs that still require ``processed = false``, so a
+payment can never be processed twice, and both keep the ledger totals in step.
+``toggle_deducted`` flips the deducted flag in the same way.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import BooleanField, Case, DecimalField, F, Value, When
+from django.utils import timezone
+
+from .ledger import UPDATE_CHUNK, payment_state, record_payment_changes
+from .models import Payment
+
+MAX_AMOUNT = Decimal('999999.99')
+
+PROCESSED = 'processed'
+ALREADY_PROCESSED = 'already_processed'
+NOT_FOUND = 'not_found'
+
+# Conditional UPDATEs tried before a payment edited concurrently is given up on
+PROCESS_ATTEMPTS = 3
+
+
+def parse_amount(value):
+    """Return an amount received rounded to cents; raise ValidationError when it is invalid"""
+    value = '' if value is None else str(value).strip()
+    if not value:
+        raise ValidationError('Amount received is required.')
+    try:
+        amount = Decimal(value)
+        if amount < 0:
+            raise ValidationError('Amount cannot be negative.')
+        if amount > MAX_AMOUNT:
+            raise ValidationError('Amount too large.')
+        # Round to 2 decimal places
+        return amount.quantize(Decimal('0.01'))
+    except (InvalidOperation, ValueError):
+        raise ValidationError('Invalid amount format.')
+
+def _mark_processed(payment_id, expected, amount_received, is_deducted, today):
+    """
+    Mark the payment processed with one UPDATE that requires it to be pending
+    with the ``expected`` ``(is_deducted, amount_received)``. Returns its
+    ``(invoice_id, due_month)``, or None when no row matched.
+    """
+    db = connections[router.db_for_write(Payment)]
+    quote = db.ops.quote_name
+    field = Payment._meta.get_field
+
+    def column(name):
+        return quote(field(name).column)
+
+    def prep(name, value):
+        return field(name).get_db_prep_save(value, db)
+
+    sql = (
+        f'UPDATE {quote(Payment._meta.db_table)} '
+        f'SET {column("amount_received")} = %s, {column("is_deducted")} = %s, '
+        f'{column("processed")} = %s, {column("processed_date")} = %s '
+        f'WHERE {column("id")} = %s AND {column("processed")} = %s '
+        f'AND {column("is_deducted")} = %s AND {column("amount_received")} = %s '
+        f'RETURNING {column("invoice")}, {column("due_month")}'
+    )
+    with db.cursor() as cursor:
+        cursor.execute(sql, [
+            prep('amount_received', amount_received), prep('is_deducted', is_deducted),
+            prep('processed', True), prep('processed_date', today),
+            payment_id, prep('processed', False),
+            prep('is_deducted', expected[0]), prep('amount_received', expected[1]),
+        ])
+        row = cursor.fetchone()
+    return row and (row[0], field('due_month').to_python(row[1]))
+
+
+def process_pending_payment(payment_id, amount_received, is_deducted, today=None):
+    """
+    Mark one pending payment processed.
+
+    The UPDATE runs first and takes no lock beforehand: it only matches
+    while the payment is pending with the deducted flag and amount it is
+    expected to have, so those values give the ledger delta. A new payment
+    is expected to have the model defaults; when the UPDATE matches nothing,
+    the payment is read once to tell NOT_FOUND and ALREADY_PROCESSED from
+    a pending payment that was edited, and the UPDATE is retried with the
+    values read, at most PROCESS_ATTEMPTS times. Of two concurrent calls
+    only one matches. Returns PROCESSED, ALREADY_PROCESSED or NOT_FOUND.
+    """
+    today = today or timezone.now().date()
+    expected = (False, Decimal('0'))
+    for _ in range(PROCESS_ATTEMPTS):
+        with transaction.atomic():
+            key = _mark_processed(payment_id, expected, amount_received, is_deducted, today)
+            if key:
+                record_payment_changes([((*key, False, *expected), (*key, True, is_deducted, amount_received))])
+                return PROCESSED
+        current = Payment.objects.filter(pk=payment_id).values_list('processed', 'is_deducted', 'amount_received').first()
+        if current is None:
+            return NOT_FOUND
+        if current[0]:
+            return ALREADY_PROCESSED
+        expected = current[1:]
+    raise DatabaseError(f'Payment {payment_id} kept changing while it was being processed.')
+
+
+def process_payments(entries, today=None):
+    """
+    Process ``{payment_id: (amount_received, is_deducted)}`` in one transaction.
+
+    The pending payments are locked and updated by one UPDATE per chunk
+    that still requires ``processed = false``. Returns the status of every
+    payment id: PROCESSED, ALREADY_PROCESSED or NOT_FOUND.
+    """
+    today = today or timezone.now().date()
+    entries = dict(entries)
+    with transaction.atomic():
+        pending = Payment.objects.select_for_update().filter(pk__in=entries, processed=False).only(
+            'invoice_id', 'due_month', 'processed', 'is_deducted', 'amount_received',
+        )
+        before = {payment.pk: payment_state(payment) for payment in pending}
+
+        ids = list(before)
+        for start in range(0, len(ids), UPDATE_CHUNK):
+            chunk = ids[start:start + UPDATE_CHUNK]
+            Payment.objects.filter(pk__in=chunk, processed=False).update(
+                amount_received=Case(
+                    *[When(pk=pk, then=Value(entries[pk][0])) for pk in chunk],
+                    output_field=DecimalField(max_digits=10, decimal_places=2),
+                ),
+                is_deducted=Case(
+                    *[When(pk=pk, then=Value(entries[pk][1])) for pk in chunk],
+                    output_field=BooleanField(),
+                ),
+                processed=True,
+                processed_date=today,
+            )
+
+        record_payment_changes(
+            (state, (state[0], state[1], True, entries[pk][1], entries[pk][0])) for pk, state in before.items()
+        )
+
+    existing = set(Payment.objects.filter(pk__in=entries.keys() - before.keys()).values_list('pk', flat=True))
+    return {
+        pk: PROCESSED if pk in before else ALREADY_PROCESSED if pk in existing else NOT_FOUND
+        for pk in entries
+    }
+
+
+def _before_toggle(state):
+    """The state a toggled payment had before its flag was flipped"""
+    invoice_id, due_month, processed, is_deducted, amount = state
+    return invoice_id, due_month, processed, not is_deducted, amount
+
+
+def toggle_deducted(payment_ids):
+    """
+    Flip ``is_deducted`` of the given payments with one UPDATE.
+
+    The updated rows stay locked until the transaction ends, so reading them
+    back gives their exact new state, and the previous state only differs
+    by the flag. Returns ``{payment_id: payment_state}`` of the toggled
+    payments.
+    """
+    with transaction.atomic():
+        payments = Payment.objects.filter(pk__in=payment_ids)
+        if not payments.update(is_deducted=~F('is_deducted')):
+            return {}
+        after = {
+            pk: (invoice_id, due_month, processed, is_deducted, amount)
+            for pk, invoice_id, due_month, processed, is_deducted, amount in payments.values_list(
+                'pk', 'invoice_id', 'due_month', 'processed', 'is_deducted', 'amount_received',
+            )
+        }
+        record_payment_changes((_before_toggle(state), state) for state in after.values())
+    return after
@@ -1,3 +1,524 @@
-from django.test import TestCase
+import io
+import json
+import tempfile
+import threading
+from datetime import date, timedelta
+from unittest import skipIf
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from addinvoice.models import Invoice
+from statement.models import MonthlySummary
+from .generation import generate_pending_payments
+from .ledger import COUNTER_FIELDS, SUMMARY_FIELDS, rebuild_invoice_counters, rebuild_monthly_summary
+from .locks import job_lock
+from .models import Payment
+from .processing import ALREADY_PROCESSED, NOT_FOUND, PROCESSED, process_pending_payment
+
+
+def _month(offset):
+    """First day of the month ``offset`` months before the current one"""
+    month = date.today().replace(day=1)
+    for _ in range(offset):
+        month = (month - timedelta(days=1)).replace(day=1)
+    return month
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class PendingPaymentsViewTests(TestCase):
+    def setUp(self):
+        # The cache may not live in the test database
+        cache.clear()
+        self.user = get_user_model().objects.create_user('operator', password='secret')
+        self.client.force_login(self.user)
+
+    def _create_invoice(self, name, months, processed=0, deduction_periods=0):
+        invoice = Invoice.objects.create(
+            name=name,
+            start_date=_month(months),
+            end_date=_month(0) + timedelta(days=365),
+            monthly_amount=Decimal('100.00'),
+            deduction_periods=deduction_periods,
+        )
+        for offset in range(months, 0, -1):
+            Payment.objects.create(
+                invoice=invoice,
+                due_date=_month(offset),
+                processed=months - offset < processed,
+            )
+        rebuild_invoice_counters(Invoice.objects.filter(pk=invoice.pk))
+        rebuild_monthly_summary()
+        return invoice
+
+    def _count_queries(self, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('processpay:pending_payments'), params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_pending_payments(self):
+        self._create_invoice('Small', months=2)
+        _, baseline = self._count_queries()
+
+        for i in range(10):
+            self._create_invoice(f'Invoice {i}', months=6, processed=2, deduction_periods=3)
+        response, queries = self._count_queries()
+
+        self.assertEqual(len(response.context['payments']), 2 + 10 * 4)
+        self.assertEqual(queries, baseline)
+
+    def test_should_be_deducted_follows_processed_count(self):
+        self._create_invoice('Deducting', months=4, processed=2, deduction_periods=3)
+        self._create_invoice('Exhausted', months=4, processed=3, deduction_periods=3)
+        self._create_invoice('Never', months=2, deduction_periods=0)
+
+        response, _ = self._count_queries()
+        flags = {(p.invoice.name, p.should_be_deducted) for p in response.context['payments']}
+
+        self.assertEqual(flags, {('Deducting', True), ('Exhausted', False), ('Never', False)})
+
+    @override_settings(PENDING_PAYMENTS_PAGE_SIZE=4)
+    def test_pages_follow_the_cursor_at_constant_cost(self):
+        for i in range(3):
+            self._create_invoice(f'Invoice {i}', months=5)
+        expected = list(Payment.objects.order_by('due_date', 'id').values_list('id', flat=True))
+
+        seen, costs, params = [], set(), {}
+        while True:
+            response, queries = self._count_queries(**params)
+            seen.extend(payment.id for payment in response.context['payments'])
+            costs.add(queries)
+            if not response.context['next_cursor']:
+                break
+            params['after'] = response.context['next_cursor']
+
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(costs), 1)
+
+    def test_filters_by_invoice_and_due_month(self):
+        self._create_invoice('Wanted', months=6)
+        self._create_invoice('Other', months=6)
+
+        response, _ = self._count_queries(
+            invoice='Wanted', from_month=_month(5).strftime('%Y-%m'), to_month=_month(3).strftime('%Y-%m'))
+
+        self.assertEqual(
+            [(p.invoice.name, p.due_date) for p in response.context['payments']],
+            [('Wanted', _month(offset)) for offset in (5, 4, 3)],
+        )
+
+    def _summary(self):
+        return list(MonthlySummary.objects.values_list('month', *SUMMARY_FIELDS))
+
+    def test_processing_updates_invoice_counters(self):
+        invoice = self._create_invoice('Counted', months=3, processed=1)
+        payment = invoice.payments.filter(processed=False).earliest('due_date')
+
+        self.client.post(reverse('processpay:process_payment', args=[payment.pk]),
+                         {'amount_received': '80.00', 'is_deducted': 'on'})
+        self.client.post(reverse('statement:toggle_deducted', args=[payment.pk]))
+
+        invoice.refresh_from_db()
+        counters = [getattr(invoice, name) for name in COUNTER_FIELDS]
+        summary = self._summary()
+        rebuild_invoice_counters(Invoice.objects.filter(pk=invoice.pk))
+        rebuild_monthly_summary()
+        invoice.refresh_from_db()
+        self.assertEqual(counters, [getattr(invoice, name) for name in COUNTER_FIELDS])
+        self.assertEqual(counters, [2, Decimal('80.00'), Decimal('0.00'), 1])
+        self.assertEqual(summary, self._summary())
+
+    def test_bulk_processing_reports_each_row(self):
+        invoice = self._create_invoice('Bulk', months=4, processed=1)
+        done, first, second, third = invoice.payments.order_by('due_date')
+
+        response = self.client.post(
+            reverse('processpay:bulk_process_payments'),
+            json.dumps({'payments': [
+                {'id': first.pk, 'amount_received': '100', 'is_deducted': True},
+                {'id': second.pk, 'amount_received': '12.346'},
+                {'id': third.pk, 'amount_received': '-1'},
+                {'id': first.pk, 'amount_received': '100'},
+                {'id': done.pk, 'amount_received': '100'},
+                {'id': 0, 'amount_received': '100'},
+                {'id': 'x'},
+            ]}),
+            content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'processed': 2, 'results': [
+            {'id': first.pk, 'status': 'processed', 'amount_received': '100.00'},
+            {'id': second.pk, 'status': 'processed', 'amount_received': '12.35'},
+            {'id': third.pk, 'status': 'invalid', 'error': 'Amount cannot be negative.'},
+            {'id': first.pk, 'status': 'invalid', 'error': 'Duplicate payment id.'},
+            {'id': done.pk, 'status': 'already_processed'},
+            {'id': 0, 'status': 'not_found'},
+            {'id': 'x', 'status': 'invalid', 'error': 'Invalid payment id.'},
+        ]})
+        first.refresh_from_db()
+        self.assertEqual((first.processed, first.is_deducted, first.amount_received), (True, True, Decimal('100.00')))
+
+        invoice.refresh_from_db()
+        counters = [getattr(invoice, name) for name in COUNTER_FIELDS]
+        summary = self._summary()
+        rebuild_invoice_counters(Invoice.objects.filter(pk=invoice.pk))
+        rebuild_monthly_summary()
+        invoice.refresh_from_db()
+        self.assertEqual(counters, [getattr(invoice, name) for name in COUNTER_FIELDS])
+        self.assertEqual(summary, self._summary())
+
+
+class ProcessPendingPaymentTests(TestCase):
+    def setUp(self):
+        self.invoice = Invoice.objects.create(
+            name='Single', start_date=_month(2), end_date=_month(0),
+            monthly_amount=Decimal('100.00'),
+        )
+        self.payment = Payment.objects.create(invoice=self.invoice, due_date=_month(1))
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+
+    def _ledger(self):
+        self.invoice.refresh_from_db()
+        return (
+            [getattr(self.invoice, name) for name in COUNTER_FIELDS],
+            list(MonthlySummary.objects.order_by('month').values_list(*SUMMARY_FIELDS)),
+        )
+
+    def assertLedgerRebuilds(self):
+        ledger = self._ledger()
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+        self.assertEqual(ledger, self._ledger())
+
+    def test_pending_payment_is_updated_without_reading_it_first(self):
+        with CaptureQueriesContext(connection) as queries:
+            status = process_pending_payment(self.payment.pk, Decimal('100.00'), False)
+
+        self.assertEqual(status, PROCESSED)
+        table = Payment._meta.db_table
+        payment_queries = [query['sql'] for query in queries if table in query['sql']]
+        self.assertEqual(len(payment_queries), 1)
+        self.assertTrue(payment_queries[0].startswith('UPDATE'))
+        self.assertLedgerRebuilds()
+
+    def test_edited_pending_payment_is_retried_with_its_values(self):
+        Payment.objects.filter(pk=self.payment.pk).update(is_deducted=True, amount_received=Decimal('30.00'))
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+
+        self.assertEqual(process_pending_payment(self.payment.pk, Decimal('100.00'), False), PROCESSED)
+        self.payment.refresh_from_db()
+        self.assertEqual(
+            (self.payment.processed, self.payment.is_deducted, self.payment.amount_received),
+            (True, False, Decimal('100.00')),
+        )
+        self.assertLedgerRebuilds()
+
+    def test_payment_is_processed_once(self):
+        process_pending_payment(self.payment.pk, Decimal('100.00'), False)
+        ledger = self._ledger()
+
+        self.assertEqual(process_pending_payment(self.payment.pk, Decimal('50.00'), True), ALREADY_PROCESSED)
+        self.assertEqual(process_pending_payment(0, Decimal('50.00'), True), NOT_FOUND)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.amount_received, Decimal('100.00'))
+        self.assertEqual(ledger, self._ledger())
+
+
+class ConcurrentProcessingTests(TransactionTestCase):
+    @skipIf(connection.vendor == 'sqlite', "SQLite's in-memory test database is not shared between threads")
+    def test_payment_is_processed_once(self):
+        invoice = Invoice.objects.create(
+            name='Raced', start_date=_month(1), end_date=_month(0),
+            monthly_amount=Decimal('100.00'),
+        )
+        payment = Payment.objects.create(invoice=invoice, due_date=_month(1))
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+
+        operators = 8
+        barrier = threading.Barrier(operators)
+        statuses = []
+
+        def operator(amount):
+            try:
+                barrier.wait()
+                statuses.append(process_pending_payment(payment.pk, amount, False))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=operator, args=(Decimal(i),)) for i in range(1, operators + 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses.count(PROCESSED), 1)
+        payment.refresh_from_db()
+        invoice.refresh_from_db()
+        self.assertEqual((invoice.processed_count, invoice.pending_count), (1, 0))
+        self.assertEqual(invoice.received_total, payment.amount_received)
+        self.assertEqual(MonthlySummary.objects.get().received_amount, payment.amount_received)
+
+
+class JobLockTests(TestCase):
+    def setUp(self):
+        lock_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(lock_dir.cleanup)
+        self.enterContext(override_settings(JOB_LOCK_DIR=lock_dir.name))
+
+    def _hold_elsewhere(self, name, while_held):
+        """Run ``while_held`` while a thread with its own connection holds the lock"""
+        taken, release = threading.Event(), threading.Event()
+        held = []
+
+        def holder():
+            try:
+                with job_lock(name) as acquired:
+                    held.append(acquired)
+                    taken.set()
+                    release.wait()
+            finally:
+                taken.set()
+                connections.close_all()
+
+        thread = threading.Thread(target=holder)
+        thread.start()
+        try:
+            taken.wait()
+            self.assertEqual(held, [True])
+            while_held()
+        finally:
+            release.set()
+            thread.join()
+
+    def test_lock_is_held_by_one_process_at_a_time(self):
+        def try_lock():
+            with job_lock('test') as acquired:
+                self.assertFalse(acquired)
+
+        self._hold_elsewhere('test', try_lock)
+        with job_lock('test') as acquired:
+            self.assertTrue(acquired)
+
+    def test_generation_is_skipped_while_the_lock_is_held(self):
+        Invoice.objects.create(name='Locked', start_date=_month(1), end_date=_month(0),
+                               monthly_amount=Decimal('100.00'))
+        out = io.StringIO()
+
+        self._hold_elsewhere('generate_payments', lambda: call_command('generate_payments', stdout=out))
+
+        self.assertIn('Another process is generating payments', out.getvalue())
+        self.assertFalse(Payment.objects.exists())
+
+
+class PaymentQueryPlanTests(TestCase):
+    """The main Payment queries of each view must be able to use an index"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('operator', password='secret')
+        invoices = Invoice.objects.bulk_create(
+            Invoice(
+                name=f'Invoice {i}',
+                start_date=_month(24),
+                end_date=_month(0) + timedelta(days=365),
+                monthly_amount=Decimal('100.00'),
+                deduction_periods=3,
+            )
+            for i in range(50)
+        )
+        Payment.objects.bulk_create(
+            Payment(invoice=invoice, due_date=_month(offset), due_month=_month(offset), processed=offset > 2)
+            for invoice in invoices
+            for offset in range(24, 0, -1)
+        )
+        cls.invoice = invoices[0]
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def _full_scans(self, sql, filtered=()):
+        """
+        Return the plan steps of ``sql`` that read a whole table or index.
+
+        PostgreSQL plans with sequential scans disabled, so a remaining Seq
+        Scan, or an index scan without an index condition, means no index
+        fits the query. Scans of partial indexes only read matching rows.
+        Only Payment is checked there: with sequential scans off, joining
+        every pending payment's invoice becomes a full primary key scan.
+        Scans of the ``filtered`` models must not apply a Filter, i.e. a
+        condition on their rows that no index serves.
+        """
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+                partial = {index.name for index in Payment._meta.indexes if index.condition}
+                filtered_tables = {model._meta.db_table for model in filtered}
+                nodes, scans = [cursor.fetchone()[0][0]['Plan']], []
+                while nodes:
+                    node = nodes.pop()
+                    nodes.extend(node.get('Plans', []))
+                    if node.get('Relation Name') in filtered_tables and 'Filter' in node:
+                        scans.append(f"Filter on {node['Relation Name']}")
+                    if node.get('Relation Name') != Payment._meta.db_table:
+                        continue
+                    if node['Node Type'] == 'Seq Scan' or (
+                        node['Node Type'] in ('Index Scan', 'Index Only Scan')
+                        and 'Index Cond' not in node and node['Index Name'] not in partial
+                    ):
+                        scans.append(f"{node['Node Type']} on {node['Relation Name']}")
+                return scans
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall() if row[-1].startswith('SCAN ') and 'USING' not in row[-1]]
+
+    def assertPaymentQueriesUseIndexes(self, url, filtered=()):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        queries = [q['sql'] for q in context.captured_queries
+                   if q['sql'].startswith('SELECT') and Payment._meta.db_table in q['sql']]
+        self.assertTrue(queries)
+        for sql in queries:
+            self.assertEqual(self._full_scans(sql, filtered), [], sql)
+
+    def test_pending_payments(self):
+        self.assertPaymentQueriesUseIndexes(reverse('processpay:pending_payments'))
+
+    def test_pending_payments_page(self):
+        payment = Payment.objects.filter(processed=False).order_by('due_date', 'id')[20]
+        self.assertPaymentQueriesUseIndexes(
+            reverse('processpay:pending_payments') + f'?after={payment.due_date}.{payment.pk}')
+
+    def test_pending_payments_of_invoice(self):
+        self.assertPaymentQueriesUseIndexes(
+            reverse('processpay:pending_payments') + f'?invoice={self.invoice.name}&from_month={_month(2):%Y-%m}',
+            filtered=[Invoice],
+        )
+
+    def test_invoice_detail(self):
+        self.assertPaymentQueriesUseIndexes(reverse('statement:invoice_detail', args=[self.invoice.pk]))
+
+
+class GenerationTests(TestCase):
+    def _invoice(self, name, start_date, end_date):
+        return Invoice.objects.create(
+            name=name, start_date=start_date, end_date=end_date, monthly_amount=Decimal('100.00'),
+        )
+
+    def _due_dates(self, invoice):
+        return list(invoice.payments.order_by('due_date').values_list('due_date', flat=True))
+
+    def _ledger(self):
+        return (list(Invoice.objects.order_by('pk').values_list(*COUNTER_FIELDS)),
+                list(MonthlySummary.objects.values_list('month', *SUMMARY_FIELDS)))
+
+    def assertLedgerInStep(self):
+        ledger = self._ledger()
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+        self.assertEqual(ledger, self._ledger())
+
+    def test_creates_every_due_month_in_batches(self):
+        invoice = self._invoice('Monthly', date(2025, 1, 15), date(2026, 1, 15))
+        other = self._invoice('Other', date(2025, 3, 1), date(2026, 3, 1))
+
+        result = generate_pending_payments(today=date(2025, 4, 14), batch_size=2)
+
+        # April is not due before the 15th
+        self.assertEqual(result.created, 5)
+        self.assertEqual(self._due_dates(invoice), [date(2025, month, 1) for month in (1, 2, 3)])
+        self.assertEqual(self._due_dates(other), [date(2025, 3, 1), date(2025, 4, 1)])
+        self.assertLedgerInStep()
+
+    def test_start_day_is_clamped_to_short_months(self):
+        invoice = self._invoice('Month end', date(2025, 1, 31), date(2026, 1, 31))
+
+        generate_pending_payments(today=date(2025, 2, 27))
+        self.assertEqual(self._due_dates(invoice), [date(2025, 1, 1)])
+
+        generate_pending_payments(today=date(2025, 2, 28))
+        self.assertEqual(self._due_dates(invoice), [date(2025, 1, 1), date(2025, 2, 1)])
+
+    def test_ended_invoices_are_not_expanded_again(self):
+        invoice = self._invoice('Ended', date(2025, 1, 1), date(2025, 3, 10))
+
+        self.assertEqual(generate_pending_payments(today=date(2025, 6, 1)).created, 3)
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.generated_through, date(2025, 3, 1))
+
+        # Months at or before the watermark are not looked at again
+        invoice.payments.filter(due_date=date(2025, 2, 1)).delete()
+        self.assertEqual(generate_pending_payments(today=date(2025, 7, 1)).created, 0)
+
+    def test_only_months_after_the_watermark_are_added(self):
+        invoice = self._invoice('Running', date(2025, 1, 1), date(2026, 1, 1))
+        generate_pending_payments(today=date(2025, 2, 1))
+        invoice.payments.filter(due_date=date(2025, 1, 1)).delete()
+
+        self.assertEqual(generate_pending_payments(today=date(2025, 3, 1)).created, 1)
+        self.assertEqual(self._due_dates(invoice), [date(2025, 2, 1), date(2025, 3, 1)])
+
+    def test_editing_the_dates_resets_the_watermark(self):
+        invoice = self._invoice('Edited', date(2025, 3, 1), date(2026, 3, 1))
+        generate_pending_payments(today=date(2025, 4, 1))
+        self.client.force_login(get_user_model().objects.create_user('operator', password='secret'))
+
+        self.client.post(reverse('addinvoice:edit_invoice', args=[invoice.pk]), {
+            'name': 'Edited', 'start_date': '2025-01-01', 'end_date': '2026-03-01',
+            'monthly_amount': '100.00', 'deduction_periods': 0,
+        })
+        invoice.refresh_from_db()
+        self.assertIsNone(invoice.generated_through)
+
+        self.assertEqual(generate_pending_payments(today=date(2025, 4, 1)).created, 2)
+        self.assertEqual(self._due_dates(invoice), [date(2025, month, 1) for month in (1, 2, 3, 4)])
+        self.assertLedgerInStep()
+
+    def test_reruns_create_nothing(self):
+        self._invoice('Repeated', date(2025, 1, 1), date(2026, 1, 1))
+        generate_pending_payments(today=date(2025, 3, 1))
+        ledger = self._ledger()
+
+        self.assertEqual(generate_pending_payments(today=date(2025, 3, 1)).created, 0)
+        self.assertEqual(self._ledger(), ledger)
+
+    def test_existing_months_are_not_duplicated(self):
+        invoice = self._invoice('Partly paid', date(2025, 1, 1), date(2026, 1, 1))
+        Payment.objects.create(invoice=invoice, due_date=date(2025, 2, 10), processed=True,
+                               amount_received=Decimal('100.00'))
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+
+        # Another run that has not seen the watermark yet inserts the same months
+        result = generate_pending_payments(today=date(2025, 3, 1))
+        Invoice.objects.filter(pk=invoice.pk).update(generated_through=None)
+        rerun = generate_pending_payments(today=date(2025, 3, 1))
+
+        self.assertEqual((result.created, rerun.created), (2, 0))
+        self.assertEqual(self._due_dates(invoice), [date(2025, 1, 1), date(2025, 2, 10), date(2025, 3, 1)])
+        self.assertLedgerInStep()
+
+    def test_created_rows_are_counted_without_reading_the_payments(self):
+        for i in range(3):
+            self._invoice(f'Invoice {i}', date(2024, 1, 1), date(2026, 1, 1))
+
+        with CaptureQueriesContext(connection) as queries:
+            result = generate_pending_payments(today=date(2025, 3, 1), batch_size=10)
+
+        self.assertEqual(result.created, 3 * 15)
+        table = Payment._meta.db_table
+        self.assertEqual([query['sql'] for query in queries if f'FROM "{table}"' in query['sql']], [])
+        self.assertLedgerInStep()
@@ -6,4 +6,5 @@ app_name = 'processpay'
 urlpatterns = [
     path('pending/', views.pending_payments, name='pending_payments'),
     path('process/<int:payment_id>/', views.process_payment, name='process_payment'),
+    path('process/bulk/', views.bulk_process_payments, name='bulk_process_payments'),
 ]
\ No newline at end of file
@@ -1,106 +1,122 @@
-from decimal import Decimal, InvalidOperation
-from django.shortcuts import render, redirect, get_object_or_404
+import json
+from django.conf import settings
+from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ValidationError
+from django.db import DatabaseError
+from django.db.models import BooleanField, Case, F, Value, When
+from django.http import Http404, JsonResponse
+from django.views.decorators.http import require_POST
+from .forms import PendingPaymentFilterForm
 from .models import Payment
-from addinvoice.models import Invoice
+from .pagination import payment_page
+from .processing import ALREADY_PROCESSED, NOT_FOUND, PROCESSED, parse_amount, process_payments, process_pending_payment
 from django.utils import timezone
 from django.contrib import messages
 
-def _generate_pending_payments():
-    """
-    Generates monthly payments for active invoices, including past due ones.
-    This is the core logic from the management command.
-    """
-    today = timezone.now().date()
-    invoices = Invoice.objects.filter(start_date__lte=today)
-
-    for invoice in invoices:
-        start_month = invoice.start_date
-        end_month = min(today, invoice.end_date) if invoice.end_date else today
-
-        current_month = start_month
-        while current_month <= end_month:
-            # Check if a payment for this month already exists
-            if not Payment.objects.filter(invoice=invoice, due_date__year=current_month.year, due_date__month=current_month.month).exists():
-                due_date = current_month.replace(day=1)
-                Payment.objects.create(
-                    invoice=invoice,
-                    due_date=due_date,
-                    processed=False
-                )
-            
-            # Move to the next month
-            if current_month.month == 12:
-                current_month = current_month.replace(year=current_month.year + 1, month=1)
-            else:
-                current_month = current_month.replace(month=current_month.month + 1)
-
 @login_required
 def pending_payments(request):
-    # 1. Generate any missing payment records
-    _generate_pending_payments()
-    
-    # 2. Fetch pending payments that are due
+    # 1. Fetch pending payments that are due
+    # Missing payments are created by the `generate_payments --loop` scheduler
     today = timezone.now().date()
-    pending_payments_list = Payment.objects.filter(processed=False, due_date__lte=today).order_by('due_date')
+    filter_form = PendingPaymentFilterForm(request.GET)
+    payments = filter_form.filter(Payment.objects.filter(processed=False, due_date__lte=today))
 
-    # 3. Add logic to determine if 'is_deducted' should be pre-checked
-    for payment in pending_payments_list:
-        processed_count = Payment.objects.filter(invoice=payment.invoice, processed=True).count()
-        if payment.invoice.deduction_periods and processed_count < payment.invoice.deduction_periods:
-            payment.should_be_deducted = True
-        else:
-            payment.should_be_deducted = False
+    # 2. Pre-check 'is_deducted' while the invoice still has deduction periods left
+    payments = (
+        payments
+        .select_related('invoice')
+        .annotate(should_be_deducted=Case(
+            When(invoice__deduction_periods__gt=0,
+                 invoice__processed_count__lt=F('invoice__deduction_periods'),
+                 then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField(),
+        ))
+    )
 
-    return render(request, 'processpay/pending_payments.html', {'payments': pending_payments_list})
+    # 3. One page after the `after` cursor, ordered by (due_date, id)
+    page = payment_page(payments, request.GET.get('after'), settings.PENDING_PAYMENTS_PAGE_SIZE)
+
+    return render(request, 'processpay/pending_payments.html', {
+        'payments': page.payments,
+        'next_cursor': page.next_cursor,
+        'filter_form': filter_form,
+    })
+
+def _back_to_list(request):
+    # Keep the filters and page the payment was processed from
+    query = request.GET.urlencode()
+    return redirect(reverse('processpay:pending_payments') + (f'?{query}' if query else ''))
 
 @login_required
 def process_payment(request, payment_id):
-    payment = get_object_or_404(Payment, id=payment_id)
-    
-    # Security: Ensure payment is not already processed
-    if payment.processed:
-        messages.error(request, 'Payment has already been processed.')
-        return redirect('processpay:pending_payments')
-    
     if request.method == 'POST':
+        # Validate and sanitize amount_received
         try:
-            # Validate and sanitize amount_received
-            amount_str = request.POST.get('amount_received', '').strip()
-            if not amount_str:
-                messages.error(request, 'Amount received is required.')
-                return redirect('processpay:pending_payments')
-            
-            try:
-                amount_received = Decimal(amount_str)
-                if amount_received < 0:
-                    messages.error(request, 'Amount cannot be negative.')
-                    return redirect('processpay:pending_payments')
-                if amount_received > Decimal('999999.99'):
-                    messages.error(request, 'Amount too large.')
-                    return redirect('processpay:pending_payments')
-                # Round to 2 decimal places
-                amount_received = amount_received.quantize(Decimal('0.01'))
-            except (InvalidOperation, ValueError):
-                messages.error(request, 'Invalid amount format.')
-                return redirect('processpay:pending_payments')
-            
-            # Validate boolean field
-            is_deducted = request.POST.get('is_deducted') == 'on'
-            
-            # Update payment with validated data
-            payment.amount_received = amount_received
-            payment.is_deducted = is_deducted
-            payment.processed = True
-            payment.processed_date = timezone.now().date()
-            payment.save()
-            
-            messages.success(request, f'Payment processed successfully. Amount: ${amount_received}')
-            return redirect('processpay:pending_payments')
-            
-        except Exception as e:
+            amount_received = parse_amount(request.POST.get('amount_received'))
+        except ValidationError as error:
+            messages.error(request, error.message)
+            return _back_to_list(request)
+
+        # Validate boolean field
+        is_deducted = request.POST.get('is_deducted') == 'on'
+
+        # Conditional update; only one of two concurrent requests succeeds
+        try:
+            status = process_pending_payment(payment_id, amount_received, is_deducted)
+        except DatabaseError:
             messages.error(request, 'An error occurred while processing the payment.')
-            return redirect('processpay:pending_payments')
-        
-    return redirect('processpay:pending_payments')
+            return _back_to_list(request)
+        if status == NOT_FOUND:
+            raise Http404('No Payment matches the given query.')
+        if status == ALREADY_PROCESSED:
+            messages.error(request, 'Payment has already been processed.')
+        else:
+            messages.success(request, f'Payment processed successfully. Amount: ${amount_received}')
+
+    return _back_to_list(request)
+
+@login_required
+@require_POST
+def bulk_process_payments(request):
+    """
+    Process several payments from a JSON body
+    ``{"payments": [{"id": 1, "amount_received": "100.00", "is_deducted": false}, ...]}``.
+
+    Every entry is validated first; the valid ones are applied in a single
+    transaction. The response lists a result per entry, in request order.
+    """
+    try:
+        payments = json.loads(request.body)['payments']
+        if not isinstance(payments, list):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Expected a JSON object with a "payments" list.'}, status=400)
+
+    results, entries = [], {}
+    for item in payments:
+        payment_id = item.get('id') if isinstance(item, dict) else None
+        result = {'id': payment_id}
+        results.append(result)
+        try:
+            if not isinstance(payment_id, int) or isinstance(payment_id, bool):
+                raise ValidationError('Invalid payment id.')
+            if payment_id in entries:
+                raise ValidationError('Duplicate payment id.')
+            entries[payment_id] = (parse_amount(item.get('amount_received')), item.get('is_deducted') is True)
+        except ValidationError as error:
+            result.update(status='invalid', error=error.message)
+
+    statuses = process_payments(entries) if entries else {}
+    for result in results:
+        if 'status' not in result:
+            result['status'] = statuses[result['id']]
+            if result['status'] == PROCESSED:
+                result['amount_received'] = str(entries[result['id']][0])
+
+    return JsonResponse({
+        'processed': sum(result['status'] == PROCESSED for result in results),
+        'results': results,
+    })
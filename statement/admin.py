@@ -1,3 +1,17 @@
 from django.contrib import admin
+from .models import ImportJob, MonthlySummary
 
-# Register your models here.
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('original_name', 'status', 'dry_run', 'created_by', 'created_at', 'rows_processed', 'updated_count', 'error_count')
+    list_filter = ('status', 'dry_run')
+    readonly_fields = ('started_at', 'heartbeat_at', 'finished_at', 'rows_processed', 'updated_count', 'unchanged_count', 'error_count', 'message',
+                       'dry_run', 'summary')
+
+admin.site.register(ImportJob, ImportJobAdmin)
+
+class MonthlySummaryAdmin(admin.ModelAdmin):
+    list_display = ('month', 'payment_count', 'pending_count', 'due_amount', 'pending_amount', 'received_amount', 'deducted_amount')
+    readonly_fields = ('month', 'payment_count', 'pending_count', 'due_amount', 'pending_amount',
+                       'processed_amount', 'received_amount', 'deducted_amount')
+
+admin.site.register(MonthlySummary, MonthlySummaryAdmin)
@@ -0,0 +1,98 @@
+"""
+Caches of ledger data, invalidated by version numbers kept in the cache.
+
+The dashboard context is cached under a global ledger version, and each
+invoice's payment history under a per-invoice version. Every payment or
+invoice change bumps the versions it affects (``processpay.ledger``, the
+model signals in ``statement.signals`` and the COPY import), so cached
+entries of older versions are simply never read again. The versions are
+only useful in a cache shared by all processes (database or Redis; see
+``statement.checks``). A bump writes a fresh clock value, which differs
+from every version handed out before, so all the keys of a change are
+written with one ``set_many``. Versions never expire. Hit and miss counts
+are kept per process, so a cached read costs no cache write.
+"""
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = 'ledger:version'
+# Bumped instead of the invoice versions when the changed invoices are unknown
+INVOICES_KEY = 'ledger:invoices-version'
+# Above this many invoices one INVOICES_KEY bump is cheaper than a bump each
+INVOICE_BUMP_LIMIT = 3
+
+
+# Hits and misses of cached_ledger_data in this process
+_stats = Counter()
+
+
+def _invoice_key(invoice_id):
+    return f'ledger:invoice:{invoice_id}:version'
+
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock so an evicted version never comes back to an old value
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def ledger_version():
+    return _version(VERSION_KEY)
+
+
+def invoice_version(invoice_id):
+    """Version of ``invoice_id``'s payments, for keys of its cached pages"""
+    keys = [INVOICES_KEY, _invoice_key(invoice_id)]
+    versions = cache.get_many(keys)
+    return '.'.join(str(versions[key] if key in versions else _version(key)) for key in keys)
+
+
+def bump_ledger_version(invoice_ids=None):
+    """
+    Invalidate cached ledger data once the current transaction commits, so
+    a concurrent request cannot cache pre-commit data under the new version.
+
+    ``invoice_ids`` are the invoices whose payments changed; None stands for
+    any invoice.
+    """
+    invoice_ids = None if invoice_ids is None else set(invoice_ids)
+
+    def bump():
+        if invoice_ids is None or len(invoice_ids) > INVOICE_BUMP_LIMIT:
+            keys = [VERSION_KEY, INVOICES_KEY]
+        else:
+            keys = [VERSION_KEY, *map(_invoice_key, invoice_ids)]
+        cache.set_many(dict.fromkeys(keys, time.time_ns()), None)
+
+    transaction.on_commit(bump)
+
+
+def cached_ledger_data(name, build):
+    """Return ``build()`` cached under ``name`` for the current ledger version"""
+    key = f'ledger:{name}:{ledger_version()}'
+    value = cache.get(key)
+    if value is not None:
+        _stats['hits'] += 1
+        return value
+    _stats['misses'] += 1
+    value = build()
+    cache.set(key, value, settings.DASHBOARD_CACHE_TIMEOUT)
+    return value
+
+
+def cache_stats():
+    """Current ledger version and this process's hit and miss counts"""
+    hits, misses = _stats['hits'], _stats['misses']
+    return {
+        'version': cache.get(VERSION_KEY),
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else None,
+    }
@@ -0,0 +1,24 @@
+"""
+System checks for the ledger caches.
+"""
+from django.conf import settings
+from django.core.checks import Error, register
+
+# Backends whose entries are only visible to the process that wrote them
+PER_PROCESS_BACKENDS = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """The ledger versions (statement/cache.py) must be shared by every process"""
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PER_PROCESS_BACKENDS:
+        return [Error(
+            f'The default cache ({backend}) is not shared between processes.',
+            hint='Ledger cache invalidation needs a database or Redis cache; see CACHES in plantcon/settings.',
+            id='statement.E001',
+        )]
+    return []
@@ -0,0 +1,642 @@
+"""
+Batched CSV import of payment updates.
+
+Rows are validated, the referenced payments and invoices are loaded with one
+``id__in``/``name__in`` lookup per batch, and only payments whose values
+actually changed are written back with one parameterized UPDATE per batch
+(``_write_payments``). The file is read as
+a stream and handled batch by batch, so memory does not grow with its size;
+by default the whole file is applied in a single transaction.
+
+``preview_payments`` runs the same steps without writing and returns the
+diff, which ``apply_changes`` can write later.
+"""
+import copy
+import csv
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from datetime import date, datetime
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connections, router, transaction
+from addinvoice.models import Invoice
+from processpay.ledger import payment_state, record_payment_changes
+from processpay.models import Payment
+from processpay.months import month_start
+from .cache import bump_ledger_version
+
+PREVIEW_SAMPLES = 20
+
+CSV_HEADER = ['Payment ID', 'Invoice Name', 'Due Date', 'Processed Date', 'Amount Received', 'Is Deducted', 'Processed']
+UPDATE_FIELDS = ['invoice', 'due_date', 'due_month', 'processed_date', 'amount_received', 'is_deducted', 'processed']
+
+
+class InvalidCSVError(Exception):
+    """The file cannot be imported at all (empty or wrong header)"""
+
+
+@dataclass
+class ImportResult:
+    rows: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def reject(self, reason, value=None):
+        """Count a row that cannot be applied"""
+        self.errors += 1
+
+
+@dataclass
+class ImportPreview(ImportResult):
+    """
+    Outcome of ``preview_payments``.
+
+    ``updated`` counts the payments that would change. ``changes`` holds
+    them as ``(payment_id, original_snapshot, new_snapshot)`` tuples in
+    UPDATE_FIELDS order, grouped by the batch that last touched them so
+    ``apply_changes`` can write them in the order the import would.
+    """
+    changed_fields: dict = field(default_factory=dict)
+    reassignments: int = 0
+    reassignment_samples: list = field(default_factory=list)
+    rejected: dict = field(default_factory=dict)
+    unknown_payment_ids: list = field(default_factory=list)
+    unknown_invoice_names: list = field(default_factory=list)
+    changes: list = field(default_factory=list)
+    # Unwritten state carried between batches
+    pending: dict = field(default_factory=dict, repr=False)
+    originals: dict = field(default_factory=dict, repr=False)
+    months: dict = field(default_factory=dict, repr=False)
+    last_batch: dict = field(default_factory=dict, repr=False)
+    batches: int = field(default=0, repr=False)
+
+    def reject(self, reason, value=None):
+        super().reject(reason, value)
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        samples = {'unknown_payment': self.unknown_payment_ids,
+                   'unknown_invoice': self.unknown_invoice_names}.get(reason)
+        if samples is not None and len(samples) < PREVIEW_SAMPLES and value not in samples:
+            samples.append(value)
+
+    def record(self, dirty):
+        """Keep the changes of a planned batch for the following batches"""
+        self.batches += 1
+        for payment, batch_original in dirty:
+            self.originals.setdefault(payment.pk, batch_original)
+            self.months[_snapshot_month_key(batch_original)] = None
+            self.months[_month_key(payment)] = payment.pk
+            self.pending[payment.pk] = payment
+            self.last_batch[payment.pk] = self.batches
+
+    def finish(self):
+        """Turn the carried state into ``changes`` and the field summary"""
+        field_names = [name for name in UPDATE_FIELDS if name != 'due_month']
+        groups = {}
+        for pk, payment in self.pending.items():
+            original, values = self.originals[pk], _snapshot(payment)
+            if values == original:
+                continue
+            groups.setdefault(self.last_batch[pk], []).append((pk, original, values))
+            for index, name in enumerate(UPDATE_FIELDS):
+                if name in field_names and values[index] != original[index]:
+                    self.changed_fields[name] = self.changed_fields.get(name, 0) + 1
+            if values[0] != original[0]:
+                self.reassignments += 1
+                if len(self.reassignment_samples) < PREVIEW_SAMPLES:
+                    self.reassignment_samples.append((pk, original[0], values[0]))
+        self.changes = [groups[batch] for batch in sorted(groups)]
+        self.updated = sum(len(group) for group in self.changes)
+        self.unchanged += len(self.pending) - self.updated
+        self.pending, self.originals, self.months, self.last_batch = {}, {}, {}, {}
+
+        names = dict(Invoice.objects.filter(
+            pk__in={invoice_id for _, old, new in self.reassignment_samples for invoice_id in (old, new)},
+        ).values_list('id', 'name'))
+        self.reassignment_samples = [
+            (pk, names.get(old), names.get(new)) for pk, old, new in self.reassignment_samples
+        ]
+
+    def summary(self):
+        """JSON-serialisable summary of the diff"""
+        return {
+            'changed': self.updated,
+            'unchanged': self.unchanged,
+            'fields': self.changed_fields,
+            'reassignments': self.reassignments,
+            'reassignment_samples': self.reassignment_samples,
+            'rejected': self.rejected,
+            'unknown_payment_ids': self.unknown_payment_ids,
+            'unknown_invoice_names': self.unknown_invoice_names,
+        }
+
+
+@dataclass
+class PaymentRow:
+    payment_id: int
+    invoice_name: str
+    due_date: object
+    processed_date: object
+    amount_received: Decimal
+    is_deducted: bool
+    processed: bool
+
+
+def _validate_payment_id(value):
+    """Validate payment ID is a positive integer"""
+    try:
+        payment_id = int(value)
+        if payment_id <= 0:
+            raise ValidationError('Payment ID must be positive')
+        return payment_id
+    except (ValueError, TypeError):
+        raise ValidationError('Invalid payment ID')
+
+
+def _validate_invoice_name(value):
+    """Validate and sanitize invoice name"""
+    if not value or not isinstance(value, str):
+        raise ValidationError('Invoice name is required')
+
+    # Sanitize: remove dangerous characters, limit length
+    sanitized = str(value).strip()[:200]
+    if not sanitized:
+        raise ValidationError('Invoice name cannot be empty')
+
+    return sanitized
+
+
+def _validate_date(value, field_name):
+    """Validate date format"""
+    if not value:
+        return None
+
+    try:
+        # Try multiple date formats
+        for fmt in ['%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y']:
+            try:
+                return datetime.strptime(value, fmt).date()
+            except ValueError:
+                continue
+        raise ValidationError(f'Invalid date format for {field_name}')
+    except Exception:
+        raise ValidationError(f'Invalid date for {field_name}')
+
+
+def _validate_amount(value):
+    """Validate monetary amount"""
+    if not value:
+        return Decimal('0.00')
+
+    try:
+        amount = Decimal(str(value))
+        if amount < 0:
+            raise ValidationError('Amount cannot be negative')
+        if amount > Decimal('999999.99'):  # Reasonable upper limit
+            raise ValidationError('Amount too large')
+        return amount.quantize(Decimal('0.01'))  # Round to 2 decimal places
+    except (InvalidOperation, ValueError, TypeError):
+        raise ValidationError('Invalid amount format')
+
+
+def _validate_boolean(value):
+    """Validate boolean value"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        return value.lower() in ('true', '1', 't', 'yes', 'on')
+    return bool(value)
+
+
+def _split_date_parser(separator, year, month, day):
+    """Build a parser for three ``separator``-joined numbers at the given positions"""
+    def parse(value):
+        parts = value.split(separator)
+        if (len(parts) != 3 or len(parts[year]) != 4
+                or not 1 <= len(parts[month]) <= 2 or not 1 <= len(parts[day]) <= 2
+                or not all(part.isascii() and part.isdigit() for part in parts)):
+            raise ValueError(value)
+        return date(int(parts[year]), int(parts[month]), int(parts[day]))
+    return parse
+
+
+_parse_dashed_date = _split_date_parser('-', 0, 1, 2)
+
+
+def _parse_iso_date(value):
+    if len(value) == 10 and value[4] == '-' and value[7] == '-' and value[5] != 'W':
+        return date.fromisoformat(value)
+    # strptime's %m/%d also accept single digits, e.g. 2025-1-5
+    return _parse_dashed_date(value)
+
+
+# Same formats, in the same order of preference, as _validate_date
+DATE_PARSERS = {
+    '%Y-%m-%d': _parse_iso_date,
+    '%m/%d/%Y': _split_date_parser('/', 2, 0, 1),
+    '%d/%m/%Y': _split_date_parser('/', 2, 1, 0),
+}
+DATE_DETECT_SAMPLES = 100
+
+
+def detect_date_format(samples):
+    """
+    Return the format that parses most of ``samples``, preferring earlier
+    entries of DATE_PARSERS on ties, or None if there are no samples.
+    """
+    best_format, best_hits = None, 0
+    for fmt, parse in DATE_PARSERS.items():
+        hits = 0
+        for value in samples:
+            try:
+                parse(value)
+                hits += 1
+            except ValueError:
+                pass
+        if hits > best_hits:
+            best_format, best_hits = fmt, hits
+            if hits == len(samples):
+                break
+    return best_format
+
+
+class DateColumn:
+    """
+    Parser for one date column of an import file.
+
+    The format is detected once from the first non-empty values and then
+    enforced for the rest of the file, replacing the per-cell strptime
+    attempts of _validate_date.
+    """
+    def __init__(self, field_name):
+        self.field_name = field_name
+        self.format = None
+        self._parse = None
+
+    def detect(self, values):
+        if self._parse is not None:
+            return
+        samples = [value for value in values if value][:DATE_DETECT_SAMPLES]
+        self.format = detect_date_format(samples)
+        if self.format:
+            self._parse = DATE_PARSERS[self.format]
+
+    def __call__(self, value):
+        if not value:
+            return None
+        try:
+            return self._parse(value)
+        except (ValueError, TypeError):
+            raise ValidationError(f'Invalid date for {self.field_name}')
+
+
+def _parse_row(row, due_dates, processed_dates):
+    """Validate and sanitize one CSV row"""
+    if len(row) < 7:
+        raise ValidationError('Missing columns')
+    due_date = due_dates(row[2])
+    if due_date is None:
+        raise ValidationError('Due date is required')
+    return PaymentRow(
+        payment_id=_validate_payment_id(row[0]),
+        invoice_name=_validate_invoice_name(row[1]),
+        due_date=due_date,
+        processed_date=processed_dates(row[3]),
+        amount_received=_validate_amount(row[4]),
+        is_deducted=_validate_boolean(row[5]),
+        processed=_validate_boolean(row[6]),
+    )
+
+
+def _snapshot(payment):
+    return tuple(getattr(payment, name if name != 'invoice' else 'invoice_id') for name in UPDATE_FIELDS)
+
+
+def _restore(payment, snapshot):
+    for name, value in zip(UPDATE_FIELDS, snapshot):
+        setattr(payment, name if name != 'invoice' else 'invoice_id', value)
+
+
+def _encode_snapshot(snapshot):
+    invoice_id, due_date, due_month, processed_date, amount, is_deducted, processed = snapshot
+    return [invoice_id, due_date.isoformat(), due_month.isoformat(),
+            processed_date.isoformat() if processed_date else None, str(amount), is_deducted, processed]
+
+
+def _decode_snapshot(data):
+    invoice_id, due_date, due_month, processed_date, amount, is_deducted, processed = data
+    return (invoice_id, date.fromisoformat(due_date), date.fromisoformat(due_month),
+            date.fromisoformat(processed_date) if processed_date else None, Decimal(amount), is_deducted, processed)
+
+
+def dump_changes(changes):
+    """JSON-compatible form of ``ImportPreview.changes``, for ``ImportJob.diff``"""
+    return [
+        [[pk, _encode_snapshot(original), _encode_snapshot(values)] for pk, original, values in batch]
+        for batch in changes
+    ]
+
+
+def load_changes(data):
+    """Inverse of ``dump_changes``"""
+    return [
+        [(pk, _decode_snapshot(original), _decode_snapshot(values)) for pk, original, values in batch]
+        for batch in data
+    ]
+
+
+def _month_key(payment):
+    return (payment.invoice_id, payment.due_month)
+
+
+def _snapshot_month_key(snapshot):
+    return (snapshot[0], snapshot[2])
+
+
+def _snapshot_state(snapshot):
+    """``payment_state`` of a snapshot, for the ledger totals"""
+    return (snapshot[0], snapshot[2], snapshot[6], snapshot[5], snapshot[4])
+
+
+def _load_invoices(names):
+    """Map each name to its oldest invoice (names are not unique)"""
+    invoices = {}
+    for invoice_id, name in Invoice.objects.filter(name__in=names).order_by('-id').values_list('id', 'name'):
+        invoices[name] = invoice_id
+    return invoices
+
+
+def _occupied_months(payments, overrides=None):
+    """
+    Return {(invoice_id, due_month): payment_id} for the target months of
+    ``payments``. ``overrides`` holds months claimed (payment id) or vacated
+    (None) by changes that have not been written yet.
+    """
+    if not payments:
+        return {}
+    keys = {_month_key(p) for p in payments}
+    occupied = {
+        (invoice_id, due_month): payment_id
+        for payment_id, invoice_id, due_month in Payment.objects.filter(
+            invoice_id__in={key[0] for key in keys},
+            due_month__in={key[1] for key in keys},
+        ).values_list('id', 'invoice_id', 'due_month')
+    }
+    for key in keys & (overrides or {}).keys():
+        if overrides[key] is None:
+            occupied.pop(key, None)
+        else:
+            occupied[key] = overrides[key]
+    return occupied
+
+
+def _reject_month_conflicts(changed, original_keys, result, overrides=None):
+    """
+    Drop from ``changed`` the payments moved onto a month their invoice
+    already has, which would break the (invoice, due_month) constraint.
+    Earlier batches are already visible to the occupancy query.
+    """
+    claimed = {}
+    moved = [p for p in changed.values() if _month_key(p) != original_keys[p.pk]]
+    occupied = _occupied_months(moved, overrides)
+    for payment in moved:
+        key = _month_key(payment)
+        if occupied.get(key, payment.pk) != payment.pk or claimed.get(key, payment.pk) != payment.pk:
+            del changed[payment.pk]
+            result.reject('month_conflict', payment.pk)
+        else:
+            claimed[key] = payment.pk
+
+
+def _plan_batch(rows, result, preview=None):
+    """
+    Work out the changes a batch of parsed rows makes, without writing them.
+
+    Returns ``(payment, original_snapshot)`` pairs for the payments whose
+    values differ. During a preview the unwritten changes of earlier batches
+    stand in for the stored rows. Otherwise the payments are locked until the
+    batch commits, so the ledger deltas are computed from the values that are
+    overwritten.
+    """
+    ids = {row.payment_id for row in rows}
+    if preview is None:
+        payments = Payment.objects.select_for_update().order_by('pk').in_bulk(ids)
+    else:
+        payments = Payment.objects.in_bulk(ids)
+        payments.update((pk, copy.copy(preview.pending[pk])) for pk in ids & preview.pending.keys())
+    invoices = _load_invoices({row.invoice_name for row in rows})
+
+    originals = {}
+    original_keys = {}
+    changed = {}
+    for row in rows:
+        payment = payments.get(row.payment_id)
+        invoice_id = invoices.get(row.invoice_name)
+        # Security: only existing payments and invoices may be referenced
+        if payment is None:
+            result.reject('unknown_payment', row.payment_id)
+            continue
+        if invoice_id is None:
+            result.reject('unknown_invoice', row.invoice_name)
+            continue
+
+        if payment.pk not in originals:
+            originals[payment.pk] = _snapshot(payment)
+            original_keys[payment.pk] = _month_key(payment)
+        payment.invoice_id = invoice_id
+        payment.due_date = row.due_date
+        payment.due_month = month_start(row.due_date)
+        payment.processed_date = row.processed_date
+        payment.amount_received = row.amount_received
+        payment.is_deducted = row.is_deducted
+        payment.processed = row.processed
+        changed[payment.pk] = payment
+
+    _reject_month_conflicts(changed, original_keys, result, preview and preview.months)
+
+    dirty = [(p, originals[p.pk]) for p in changed.values() if _snapshot(p) != originals[p.pk]]
+    result.unchanged += len(changed) - len(dirty)
+    return dirty
+
+
+def _write_payments(payments):
+    """
+    Write the UPDATE_FIELDS of ``payments`` with one ``executemany`` UPDATE.
+
+    ``bulk_update`` builds a CASE/WHEN expression per field and row, whose
+    resolution costs more Python time than the per-row saves it replaced.
+    """
+    db = connections[router.db_for_write(Payment)]
+    fields = [Payment._meta.get_field(name) for name in UPDATE_FIELDS]
+    quote = db.ops.quote_name
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        quote(Payment._meta.db_table),
+        ', '.join(f'{quote(field.column)} = %s' for field in fields),
+        quote(Payment._meta.pk.column),
+    )
+    params = [
+        [field.get_db_prep_save(getattr(payment, field.attname), db) for field in fields] + [payment.pk]
+        for payment in payments
+    ]
+    if params:
+        with db.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+
+def _apply_batch(rows, result):
+    """Apply a batch of parsed rows and write the changed payments; run in a transaction"""
+    planned = _plan_batch(rows, result)
+    dirty = [payment for payment, _ in planned]
+    _write_payments(dirty)
+    record_payment_changes((_snapshot_state(original), payment_state(payment)) for payment, original in planned)
+    result.updated += len(dirty)
+
+
+def _open_reader(text_stream):
+    """Return a csv reader positioned after the validated header row"""
+    reader = csv.reader(text_stream)
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise InvalidCSVError('Empty CSV file.')
+    if header != CSV_HEADER:
+        raise InvalidCSVError('Invalid CSV format. Please use the correct header format.')
+    return reader
+
+
+def _parsed_batches(reader, batch_size, result):
+    """Yield the valid rows of ``reader`` in batches, counting the invalid ones"""
+    due_dates = DateColumn('due_date')
+    processed_dates = DateColumn('processed_date')
+    while raw_rows := list(islice(reader, batch_size)):
+        result.rows += len(raw_rows)
+        due_dates.detect(row[2] for row in raw_rows if len(row) >= 7)
+        processed_dates.detect(row[3] for row in raw_rows if len(row) >= 7)
+        rows = []
+        for raw_row in raw_rows:
+            try:
+                rows.append(_parse_row(raw_row, due_dates, processed_dates))
+            except ValidationError:
+                result.reject('invalid_row')
+        yield rows
+
+
+def import_payments(text_stream, batch_size=None, on_batch=None, atomic=True):
+    """
+    Import payment updates from a CSV text stream.
+
+    Rows are read ``batch_size`` at a time (PAYMENT_IMPORT_BATCH_SIZE by
+    default), so only one batch is held in memory. ``on_batch`` is called
+    with the running ImportResult after every batch. With ``atomic=False``
+    each batch commits on its own, which lets other connections see the
+    progress of a long import.
+
+    Raises InvalidCSVError when the file is empty or the header does not
+    match the export format. Invalid rows are counted and skipped. On
+    PostgreSQL the rows go through the COPY engine in ``statement.pgcopy``
+    instead, which applies the whole file at once.
+    """
+    from .pgcopy import copy_enabled, copy_import
+
+    started = time.monotonic()
+    batch_size = batch_size or settings.PAYMENT_IMPORT_BATCH_SIZE
+    reader = _open_reader(text_stream)
+
+    result = ImportResult()
+    if copy_enabled():
+        # COPY staging path; the file is merged in one statement
+        copy_import(reader, result)
+        bump_ledger_version()
+        if on_batch:
+            on_batch(result)
+        return result
+
+    with transaction.atomic() if atomic else nullcontext():
+        for rows in _parsed_batches(reader, batch_size, result):
+            with transaction.atomic():
+                _apply_batch(rows, result)
+            result.elapsed = time.monotonic() - started
+            if on_batch:
+                on_batch(result)
+
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+def preview_payments(text_stream, batch_size=None, on_batch=None):
+    """
+    Dry run of ``import_payments``: nothing is written.
+
+    The file goes through the same parsing, batched lookups and checks as
+    the ORM import (also on PostgreSQL), and the resulting ImportPreview
+    carries both the summary and the exact changes, which
+    ``apply_changes`` can write later without reading the file again.
+    """
+    started = time.monotonic()
+    batch_size = batch_size or settings.PAYMENT_IMPORT_BATCH_SIZE
+    reader = _open_reader(text_stream)
+
+    preview = ImportPreview()
+    for rows in _parsed_batches(reader, batch_size, preview):
+        preview.record(_plan_batch(rows, preview, preview))
+        preview.elapsed = time.monotonic() - started
+        if on_batch:
+            on_batch(preview)
+
+    preview.finish()
+    preview.elapsed = time.monotonic() - started
+    return preview
+
+
+def apply_changes(changes, on_batch=None, atomic=True):
+    """
+    Write the changes of an ImportPreview, one preview batch at a time.
+
+    Each change only applies while the payment still has the values seen by
+    the preview; payments edited in the meantime are skipped and counted as
+    errors, as are moves onto a month that has been taken since. Payments
+    that already have the new values count as unchanged, so applying the
+    same changes again after a failure part-way finishes the job.
+    """
+    started = time.monotonic()
+    result = ImportResult()
+    with transaction.atomic() if atomic else nullcontext():
+        for batch in changes:
+            result.rows += len(batch)
+            with transaction.atomic():
+                # Locked until the batch commits, so the snapshot check holds for the write
+                payments = Payment.objects.select_for_update().order_by('pk').in_bulk([pk for pk, _, _ in batch])
+                original_keys = {}
+                states = {}
+                changed = {}
+                for pk, original, values in batch:
+                    payment = payments.get(pk)
+                    if payment is not None and _snapshot(payment) == values:
+                        result.unchanged += 1
+                        continue
+                    if payment is None or _snapshot(payment) != original:
+                        result.reject('changed_since_preview', pk)
+                        continue
+                    original_keys[pk] = _month_key(payment)
+                    states[pk] = _snapshot_state(original)
+                    _restore(payment, values)
+                    changed[pk] = payment
+                _reject_month_conflicts(changed, original_keys, result)
+                _write_payments(changed.values())
+                record_payment_changes((states[pk], payment_state(p)) for pk, p in changed.items())
+            result.updated += len(changed)
+            result.elapsed = time.monotonic() - started
+            if on_batch:
+                on_batch(result)
+
+    result.elapsed = time.monotonic() - started
+    return result
@@ -0,0 +1,183 @@
+"""
+DB-backed queue for payment CSV imports.
+
+Uploads are stored as ImportJob rows and processed by the
+``run_import_jobs`` worker, so large files never run inside a web request.
+The worker holds the job's ``job_lock`` while it runs it, which tells a
+long COPY import apart from a job whose worker was killed.
+"""
+import io
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from processpay.locks import job_lock
+from .importer import InvalidCSVError, apply_changes, dump_changes, import_payments, load_changes, preview_payments
+from .models import ImportJob
+
+
+def _job_lock(job_id):
+    return job_lock(f'import_job_{job_id}')
+
+
+def _preview_cutoff():
+    """Previews finished before this can no longer be applied"""
+    return timezone.now() - timedelta(seconds=settings.PAYMENT_IMPORT_PREVIEW_TIMEOUT)
+
+
+def enqueue_import(uploaded_file, user, dry_run=False):
+    """Store the upload and queue it for the worker"""
+    return ImportJob.objects.create(
+        csv_file=uploaded_file,
+        original_name=uploaded_file.name[:255],
+        created_by=user if user.is_authenticated else None,
+        dry_run=dry_run,
+    )
+
+
+def confirm_preview(job):
+    """
+    Queue a finished preview, or an apply that failed part-way, to have its
+    stored diff applied.
+
+    Returns False when the job is not applicable, e.g. because it was
+    already confirmed or has expired.
+    """
+    return bool(ImportJob.objects.filter(
+        Q(dry_run=True, status=ImportJob.STATUS_DONE) | Q(dry_run=False, status=ImportJob.STATUS_FAILED),
+        pk=job.pk, diff__isnull=False, finished_at__gte=_preview_cutoff(),
+    ).update(
+        dry_run=False,
+        status=ImportJob.STATUS_QUEUED,
+        started_at=None,
+        heartbeat_at=None,
+        finished_at=None,
+        rows_processed=0,
+        updated_count=0,
+        unchanged_count=0,
+        error_count=0,
+        message='',
+    ))
+
+
+def fail_stale_jobs():
+    """
+    Fail running jobs whose worker is gone: their job lock is free and they
+    have not reported progress for IMPORT_JOB_STALE_AFTER seconds. A worker
+    inside one long statement, such as the COPY merge, keeps its lock.
+
+    They are not requeued: a file that crashes the worker would otherwise
+    be retried forever. Imports can be run again instead (see ``run_job``).
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.IMPORT_JOB_STALE_AFTER)
+    stale = ImportJob.objects.filter(status=ImportJob.STATUS_RUNNING, heartbeat_at__lt=cutoff)
+    failed = 0
+    for job_id in stale.values_list('id', flat=True):
+        with _job_lock(job_id) as abandoned:
+            if abandoned:
+                failed += stale.filter(pk=job_id).update(
+                    status=ImportJob.STATUS_FAILED,
+                    message='Worker stopped responding; the import can be run again.',
+                    finished_at=timezone.now(),
+                )
+    return failed
+
+
+def claim_next_job():
+    """
+    Mark the oldest queued job as running and return it.
+
+    The claim is a conditional UPDATE, so several workers can poll the same
+    queue without running a job twice. Stale running jobs are failed first.
+    """
+    fail_stale_jobs()
+    queued = ImportJob.objects.filter(status=ImportJob.STATUS_QUEUED).order_by('created_at', 'id')
+    for job_id in queued.values_list('id', flat=True)[:10]:
+        claimed = ImportJob.objects.filter(pk=job_id, status=ImportJob.STATUS_QUEUED).update(
+            status=ImportJob.STATUS_RUNNING,
+            started_at=timezone.now(),
+            heartbeat_at=timezone.now(),
+        )
+        if claimed:
+            return ImportJob.objects.get(pk=job_id)
+    return None
+
+
+def discard_expired_previews():
+    """Drop the stored diffs of previews and failed applies that can no longer be applied"""
+    return ImportJob.objects.filter(diff__isnull=False, finished_at__lt=_preview_cutoff()).update(diff=None)
+
+
+def _report_progress(job, result):
+    ImportJob.objects.filter(pk=job.pk).update(
+        rows_processed=result.rows,
+        updated_count=result.updated,
+        unchanged_count=result.unchanged,
+        error_count=result.errors,
+        heartbeat_at=timezone.now(),
+    )
+
+
+def _run_preview(job):
+    """Diff the file against the database and store the changes on the job"""
+    with job.csv_file.open('rb') as binary_file:
+        text_stream = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+        preview = preview_payments(text_stream, on_batch=lambda result: _report_progress(job, result))
+    ImportJob.objects.filter(pk=job.pk).update(diff=dump_changes(preview.changes), summary=preview.summary())
+    return preview
+
+
+def _run_apply(job):
+    """Write the diff stored by the job's preview"""
+    result = apply_changes(load_changes(job.diff), on_batch=lambda result: _report_progress(job, result), atomic=False)
+    ImportJob.objects.filter(pk=job.pk).update(diff=None)
+    return result
+
+
+def _run_import(job):
+    """Import the uploaded file"""
+    with job.csv_file.open('rb') as binary_file:
+        text_stream = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+        return import_payments(text_stream, on_batch=lambda result: _report_progress(job, result), atomic=False)
+
+
+def run_job(job):
+    """
+    Run a claimed job to completion, holding its job lock.
+
+    Preview jobs only diff the file; a confirmed preview applies that diff
+    instead of reading the file again. Each batch commits separately so the
+    progress endpoint can follow the import, so a failure part-way leaves
+    the earlier batches applied. The import is restartable rather than
+    all-or-nothing: rows carry absolute values, so importing the same file
+    again finishes it, and a failed apply keeps its diff and can be applied
+    again, which skips the payments it already wrote. The upload is deleted
+    once the job has finished with it.
+    """
+    status, message = ImportJob.STATUS_DONE, ''
+    with _job_lock(job.pk):
+        try:
+            if job.dry_run:
+                result = _run_preview(job)
+            elif job.diff is not None:
+                result = _run_apply(job)
+            else:
+                result = _run_import(job)
+            _report_progress(job, result)
+        except InvalidCSVError as e:
+            status, message = ImportJob.STATUS_FAILED, str(e)
+        except Exception as e:
+            status, message = ImportJob.STATUS_FAILED, f'Error processing file: {str(e)[:100]}'
+
+        if job.csv_file:
+            job.csv_file.delete(save=False)
+        ImportJob.objects.filter(pk=job.pk).update(
+            csv_file='',
+            status=status,
+            message=message,
+            finished_at=timezone.now(),
+        )
+    job.refresh_from_db()
+    return job
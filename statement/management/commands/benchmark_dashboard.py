@@ -0,0 +1,105 @@
+import time
+from datetime import date
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from addinvoice.models import Invoice
+from processpay.ledger import rebuild_invoice_counters, rebuild_monthly_summary
+from processpay.models import Payment
+from statement.views import _dashboard_metrics
+
+MONTHS_PER_INVOICE = 120
+
+
+class Rollback(Exception):
+    pass
+
+
+def _legacy_metrics(today):
+    """The four separate queries the dashboard used to run"""
+    return {
+        'pending_payments_count': Payment.objects.filter(processed=False).count(),
+        'total_paid': Payment.objects.filter(processed=True, is_deducted=False).aggregate(Sum('amount_received'))['amount_received__sum'] or 0,
+        'pending_this_month_amount': Payment.objects.filter(
+            processed=False,
+            due_date__year=today.year,
+            due_date__month=today.month,
+        ).aggregate(Sum('invoice__monthly_amount'))['invoice__monthly_amount__sum'] or 0,
+        'total_deducted': Payment.objects.filter(is_deducted=True).aggregate(Sum('amount_received'))['amount_received__sum'] or 0,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compares the summary-table dashboard metrics with the original four-query version on seeded data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=1_000_000,
+                            help='Number of payments to seed (rolled back afterwards).')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Timed runs per implementation; the best run is reported.')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                today = self._seed(options['payments'])
+                self._compare(today, options['repeat'])
+                raise Rollback
+        except Rollback:
+            self.stdout.write('Seeded data rolled back.')
+
+    def _seed(self, total):
+        self.stdout.write(f'Seeding {total} payments...')
+        today = date.today()
+        invoice_count = max(1, -(-total // MONTHS_PER_INVOICE))
+        start = date(today.year - MONTHS_PER_INVOICE // 12, today.month, 1)
+        invoices = Invoice.objects.bulk_create(
+            Invoice(
+                name=f'Benchmark {i}',
+                start_date=start,
+                end_date=today,
+                monthly_amount=Decimal('100.00'),
+            )
+            for i in range(invoice_count)
+        )
+
+        batch = []
+        for n in range(total):
+            invoice = invoices[n // MONTHS_PER_INVOICE]
+            offset = n % MONTHS_PER_INVOICE
+            month = date(start.year + (start.month - 1 + offset) // 12, (start.month - 1 + offset) % 12 + 1, 1)
+            processed = offset < MONTHS_PER_INVOICE - 3
+            batch.append(Payment(
+                invoice=invoice,
+                due_date=month,
+                due_month=month,
+                processed=processed,
+                amount_received=Decimal('100.00') if processed else Decimal('0.00'),
+                is_deducted=processed and offset % 10 == 0,
+            ))
+            if len(batch) == 5000:
+                Payment.objects.bulk_create(batch)
+                batch = []
+        Payment.objects.bulk_create(batch)
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+        return today
+
+    def _time(self, func, today, repeat):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func(today)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
+
+    def _compare(self, today, repeat):
+        legacy, legacy_time = self._time(_legacy_metrics, today, repeat)
+        single, single_time = self._time(_dashboard_metrics, today, repeat)
+        if legacy != single:
+            self.stderr.write(self.style.ERROR(f'Results differ: {legacy} != {single}'))
+        self.stdout.write(f'Four queries: {legacy_time * 1000:.1f} ms')
+        self.stdout.write(f'Summary:      {single_time * 1000:.1f} ms')
+        self.stdout.write(self.style.SUCCESS(f'Speed-up: {legacy_time / single_time:.2f}x'))
@@ -0,0 +1,48 @@
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand
+from statement.importer import DATE_PARSERS, DateColumn, _validate_date
+
+
+def _sample_dates(count):
+    start = date(2000, 1, 1)
+    return [start + timedelta(days=random.randrange(12000)) for _ in range(count)]
+
+
+class Command(BaseCommand):
+    help = 'Compares the per-file date parsing of the CSV import with the previous per-cell strptime version.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--values', type=int, default=200_000,
+                            help='Number of dates parsed per format.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Timed runs per implementation; the best run is reported.')
+
+    def handle(self, *args, **options):
+        dates = _sample_dates(options['values'])
+        for fmt in DATE_PARSERS:
+            values = [d.strftime(fmt) for d in dates]
+            column = DateColumn('due_date')
+            column.detect(values)
+            if column.format != fmt:
+                self.stderr.write(f'{fmt}: detected {column.format}')
+
+            legacy = self._best(lambda: [_validate_date(v, 'due_date') for v in values], options['repeat'])
+            fast = self._best(lambda: [column(v) for v in values], options['repeat'])
+            # The legacy parser reads ambiguous day-first dates as month-first
+            if [column(v) for v in values] != [datetime.strptime(v, fmt).date() for v in values]:
+                self.stderr.write(f'{fmt}: results differ')
+            self.stdout.write(
+                f'{fmt:<10} strptime {legacy * 1000:8.1f} ms   detected {fast * 1000:8.1f} ms   '
+                f'x{legacy / fast:.1f}'
+            )
+
+    def _best(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
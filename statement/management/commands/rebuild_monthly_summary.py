@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+from processpay.ledger import rebuild_monthly_summary
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the monthly payment summary used by the dashboard from all payments.'
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        months = rebuild_monthly_summary()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {months} monthly summaries in {time.monotonic() - started:.2f}s.'
+        ))
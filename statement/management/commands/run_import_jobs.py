@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from statement.jobs import claim_next_job, discard_expired_previews, run_job
+
+
+class Command(BaseCommand):
+    help = 'Processes queued payment CSV imports.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Process the queue until it is empty, then exit.')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds to wait between polls when the queue is empty.')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = claim_next_job()
+            if job is None:
+                discard_expired_previews()
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write(f'Importing {job.original_name} (job {job.pk})...')
+            job = run_job(job)
+            if job.status == job.STATUS_DONE:
+                self.stdout.write(self.style.SUCCESS(
+                    f'Job {job.pk}: {job.rows_processed} rows, {job.updated_count} updated, '
+                    f'{job.error_count} errors ({job.rows_per_second():.0f} rows/s)'
+                ))
+            else:
+                self.stderr.write(self.style.ERROR(f'Job {job.pk} failed: {job.message}'))
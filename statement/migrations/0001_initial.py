@@ -0,0 +1,36 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:04
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('csv_file', models.FileField(upload_to='imports/', verbose_name='CSV檔案')),
+                ('original_name', models.CharField(max_length=255, verbose_name='原始檔名')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=10, verbose_name='狀態')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='創建時間')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='開始時間')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='完成時間')),
+                ('rows_processed', models.PositiveIntegerField(default=0, verbose_name='已處理行數')),
+                ('updated_count', models.PositiveIntegerField(default=0, verbose_name='已更新')),
+                ('unchanged_count', models.PositiveIntegerField(default=0, verbose_name='未變更')),
+                ('error_count', models.PositiveIntegerField(default=0, verbose_name='錯誤行數')),
+                ('message', models.CharField(blank=True, max_length=255, verbose_name='訊息')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='上傳者')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statement', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='diff_token',
+            field=models.CharField(blank=True, max_length=32, verbose_name='差異代碼'),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='dry_run',
+            field=models.BooleanField(default=False, verbose_name='預覽'),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='summary',
+            field=models.JSONField(blank=True, null=True, verbose_name='差異摘要'),
+        ),
+    ]
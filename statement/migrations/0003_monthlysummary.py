@@ -0,0 +1,53 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:18
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def populate_summary(apps, schema_editor):
+    """Same computation as processpay.ledger.rebuild_monthly_summary"""
+    Payment = apps.get_model('processpay', 'Payment')
+    MonthlySummary = apps.get_model('statement', 'MonthlySummary')
+    totals = Payment.objects.order_by().values('due_month').annotate(
+        payment_count=Count('id'),
+        pending_count=Count('id', filter=Q(processed=False)),
+        due_amount=Sum('invoice__monthly_amount'),
+        pending_amount=Sum('invoice__monthly_amount', filter=Q(processed=False)),
+        processed_amount=Sum('amount_received', filter=Q(processed=True)),
+        received_amount=Sum('amount_received', filter=Q(processed=True, is_deducted=False)),
+        deducted_amount=Sum('amount_received', filter=Q(is_deducted=True)),
+    )
+    MonthlySummary.objects.bulk_create(
+        [MonthlySummary(month=row.pop('due_month'), **{name: value or 0 for name, value in row.items()})
+         for row in totals.iterator()],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('processpay', '0004_payment_indexes'),
+        ('statement', '0002_importjob_preview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True, verbose_name='月份')),
+                ('payment_count', models.IntegerField(default=0, verbose_name='付款筆數')),
+                ('pending_count', models.IntegerField(default=0, verbose_name='待處理筆數')),
+                ('due_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='應收金額')),
+                ('pending_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='待收金額')),
+                ('processed_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='已處理金額')),
+                ('received_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='實收金額')),
+                ('deducted_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='扣款金額')),
+            ],
+            options={
+                'ordering': ['month'],
+            },
+        ),
+        migrations.RunPython(populate_summary, migrations.RunPython.noop),
+    ]
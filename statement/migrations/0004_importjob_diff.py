@@ -0,0 +1,22 @@
+# Generated by Django 5.2.4 on 2026-10-17 03:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statement', '0003_monthlysummary'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='importjob',
+            name='diff_token',
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='diff',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='差異'),
+        ),
+    ]
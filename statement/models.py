@@ -1,3 +1,68 @@
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+class ImportJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    csv_file = models.FileField(upload_to='imports/', verbose_name="CSV檔案")
+    original_name = models.CharField(max_length=255, verbose_name="原始檔名")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True, verbose_name="狀態")
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, verbose_name="上傳者")
+    created_at = models.DateTimeField(default=timezone.now, verbose_name="創建時間")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="開始時間")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="完成時間")
+    # Set on claim and on every batch; a running job that stops updating it
+    # is stale once its worker no longer holds the job lock
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name="心跳時間")
+    rows_processed = models.PositiveIntegerField(default=0, verbose_name="已處理行數")
+    updated_count = models.PositiveIntegerField(default=0, verbose_name="已更新")
+    unchanged_count = models.PositiveIntegerField(default=0, verbose_name="未變更")
+    error_count = models.PositiveIntegerField(default=0, verbose_name="錯誤行數")
+    message = models.CharField(max_length=255, blank=True, verbose_name="訊息")
+    # Preview (dry-run) jobs keep their diff until it is applied or expires
+    dry_run = models.BooleanField(default=False, verbose_name="預覽")
+    diff = models.JSONField(null=True, blank=True, editable=False, verbose_name="差異")
+    summary = models.JSONField(null=True, blank=True, verbose_name="差異摘要")
+
+    def can_apply(self):
+        """A finished preview, or an apply that failed part-way, whose diff is still stored"""
+        if self.diff is None:
+            return False
+        return self.status == (self.STATUS_DONE if self.dry_run else self.STATUS_FAILED)
+
+    def rows_per_second(self):
+        if not self.started_at:
+            return 0.0
+        elapsed = ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+        return self.rows_processed / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.original_name} ({self.get_status_display()})"
+
+
+class MonthlySummary(models.Model):
+    """Payment totals per due month, kept up to date by processpay.ledger"""
+    month = models.DateField(unique=True, verbose_name="月份")
+    payment_count = models.IntegerField(default=0, verbose_name="付款筆數")
+    pending_count = models.IntegerField(default=0, verbose_name="待處理筆數")
+    due_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="應收金額")
+    pending_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="待收金額")
+    processed_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="已處理金額")
+    received_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="實收金額")
+    deducted_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0, verbose_name="扣款金額")
+
+    class Meta:
+        ordering = ['month']
+
+    def __str__(self):
+        return self.month.strftime('%Y-%m')
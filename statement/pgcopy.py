@@ -0,0 +1,379 @@
+"""
+PostgreSQL COPY engine for the payments CSV export and import.
+
+The export streams ``COPY (SELECT ...) TO STDOUT`` output in keyset chunks.
+The import feeds the uploaded rows to ``COPY FROM STDIN`` into a temporary
+staging table, checks them with the same rules as the ``_validate_*``
+helpers in ``statement.importer`` (expressed in SQL), and merges every valid
+row with one ``UPDATE ... FROM``. Other database backends use the ORM path.
+"""
+import csv
+import io
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from addinvoice.models import Invoice
+from processpay.models import Payment
+from .models import MonthlySummary
+from .importer import DATE_DETECT_SAMPLES, detect_date_format
+
+EXPORT_CHUNK_ROWS = 50000
+IMPORT_READ_ROWS = 5000
+
+PAYMENT_TABLE = Payment._meta.db_table
+INVOICE_TABLE = Invoice._meta.db_table
+
+
+def copy_enabled():
+    return connection.vendor == 'postgresql' and settings.PAYMENT_CSV_USE_COPY
+
+
+# Export
+
+def _export_boundary(cursor, last_id, chunk_rows):
+    """Return the highest payment id of the next chunk, or None for the final one"""
+    cursor.execute(
+        f'SELECT id FROM {PAYMENT_TABLE} WHERE id > %s ORDER BY id OFFSET %s LIMIT 1',
+        [last_id, chunk_rows - 1],
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def copy_export_lines(header, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Yield the payments CSV, one COPY chunk at a time"""
+    buffer = io.StringIO()
+    # COPY ends rows with LF only, so the header must too
+    csv.writer(buffer, lineterminator='\n').writerow(header)
+    yield buffer.getvalue()
+
+    last_id = 0
+    while True:
+        with connection.cursor() as cursor:
+            boundary = _export_boundary(cursor, last_id, chunk_rows)
+            upper = f'AND p.id <= {int(boundary)}' if boundary is not None else ''
+            buffer = io.StringIO()
+            cursor.copy_expert(f"""
+                COPY (
+                    SELECT p.id, i.name, p.due_date, p.processed_date, p.amount_received,
+                           CASE WHEN p.is_deducted THEN 'True' ELSE 'False' END,
+                           CASE WHEN p.processed THEN 'True' ELSE 'False' END
+                    FROM {PAYMENT_TABLE} p
+                    JOIN {INVOICE_TABLE} i ON i.id = p.invoice_id
+                    WHERE p.id > {int(last_id)} {upper}
+                    ORDER BY p.id
+                ) TO STDOUT WITH (FORMAT csv)
+            """, buffer)
+        if buffer.tell():
+            yield buffer.getvalue()
+        if boundary is None:
+            return
+        last_id = boundary
+
+
+# Import
+
+class _StagingStream:
+    """
+    Read-only file object handing CSV rows to COPY FROM STDIN.
+
+    Every row is prefixed with its line number and original column count and
+    padded or cut to the seven export columns, so short rows reach SQL
+    validation instead of aborting the COPY. The first non-empty values of
+    both date columns are kept for ``detect_date_format``.
+    """
+    def __init__(self, reader, first_line=2):
+        self._reader = reader
+        self._line = first_line
+        self._buffer = ''
+        self.rows = 0
+        self.date_samples = ([], [])
+
+    def _fill(self):
+        out = io.StringIO()
+        writer = csv.writer(out)
+        for row in self._reader:
+            writer.writerow([self._line, len(row), *(row + [''] * 7)[:7]])
+            if len(row) >= 7:
+                for samples, value in zip(self.date_samples, row[2:4]):
+                    if value and len(samples) < DATE_DETECT_SAMPLES:
+                        samples.append(value)
+            self._line += 1
+            self.rows += 1
+            if self.rows % IMPORT_READ_ROWS == 0:
+                break
+        return out.getvalue()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = self._fill()
+            if not chunk:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    readline = read
+
+
+def _date_sql(column, fmt):
+    """
+    SQL expression parsing ``column`` in the format picked by
+    ``detect_date_format``. Invalid dates, and every date when no format was
+    detected, yield NULL.
+
+    Nested CASEs make sure the integer casts and make_date() only ever see
+    text that passed the pattern and range checks.
+    """
+    if fmt is None:
+        return 'NULL::date'
+    separator = '-' if fmt == '%Y-%m-%d' else '/'
+    parts = [f"split_part({column}, '{separator}', {n})::int" for n in (1, 2, 3)]
+    if fmt == '%Y-%m-%d':
+        pattern = '^\\d{4}-\\d{1,2}-\\d{1,2}$'
+        year, month, day = parts
+    else:
+        pattern = '^\\d{1,2}/\\d{1,2}/\\d{4}$'
+        year, month, day = (parts[2], parts[0], parts[1]) if fmt == '%m/%d/%Y' else (parts[2], parts[1], parts[0])
+    return f"""CASE WHEN {column} ~ '{pattern}' THEN CASE
+        WHEN CASE WHEN {year} >= 1 AND {month} BETWEEN 1 AND 12
+                  THEN {day} BETWEEN 1 AND date_part('day', make_date({year}, {month}, 1) + interval '1 month' - interval '1 day')
+                  ELSE false END
+            THEN make_date({year}, {month}, {day})
+    END END"""
+
+
+def _boolean_sql(column):
+    """SQL version of ``_validate_boolean``"""
+    return f"lower({column}) IN ('true', '1', 't', 'yes', 'on')"
+
+
+STAGING_TABLE = 'payment_import_staging'
+
+CREATE_STAGING_SQL = f"""
+    CREATE TEMPORARY TABLE {STAGING_TABLE} (
+        line_no bigint PRIMARY KEY,
+        column_count int,
+        raw_id text, raw_name text, raw_due_date text, raw_processed_date text,
+        raw_amount text, raw_is_deducted text, raw_processed text,
+        payment_id bigint, invoice_name text, invoice_id bigint,
+        due_date date, processed_date date, amount_received numeric(10, 2),
+        is_deducted boolean, processed boolean,
+        error text
+    ) ON COMMIT DROP
+"""
+
+
+def _validate_sql(due_format, processed_format):
+    """
+    Parse the raw columns into the typed ones. Rules mirror
+    _validate_payment_id, _validate_invoice_name, DateColumn and
+    _validate_amount; each row keeps the first rule it fails.
+    """
+    return f"""
+        UPDATE {STAGING_TABLE} SET
+            invoice_name = left(regexp_replace(raw_name, '^\\s+|\\s+$', '', 'g'), 200),
+            due_date = {_date_sql('raw_due_date', due_format)},
+            processed_date = CASE WHEN raw_processed_date = '' THEN NULL ELSE {_date_sql('raw_processed_date', processed_format)} END,
+            is_deducted = {_boolean_sql('raw_is_deducted')},
+            processed = {_boolean_sql('raw_processed')},
+            payment_id = CASE WHEN raw_id ~ '^\\s*\\+?\\d{{1,18}}\\s*$' THEN btrim(raw_id)::bigint END,
+            amount_received = CASE
+                WHEN raw_amount = '' THEN 0
+                WHEN raw_amount ~ '^\\s*[+-]?(\\d+\\.?\\d*|\\.\\d+)([eE][+-]?\\d{{1,3}})?\\s*$' THEN CASE
+                    WHEN btrim(raw_amount)::numeric NOT BETWEEN 0 AND 999999.99 THEN NULL
+                    -- Round half to even, like Decimal.quantize()
+                    WHEN btrim(raw_amount)::numeric * 100 - trunc(btrim(raw_amount)::numeric * 100) = 0.5
+                         AND mod(trunc(btrim(raw_amount)::numeric * 100), 2) = 0
+                        THEN trunc(btrim(raw_amount)::numeric * 100) / 100
+                    ELSE round(btrim(raw_amount)::numeric, 2)
+                END
+            END
+    """
+
+
+CHECK_SQL = f"""
+    UPDATE {STAGING_TABLE} SET error = CASE
+        WHEN column_count < 7 THEN 'Missing columns'
+        WHEN payment_id IS NULL OR payment_id <= 0 THEN 'Invalid payment ID'
+        WHEN invoice_name = '' THEN 'Invoice name is required'
+        WHEN due_date IS NULL THEN 'Invalid due date'
+        WHEN raw_processed_date <> '' AND processed_date IS NULL THEN 'Invalid processed date'
+        WHEN amount_received IS NULL THEN 'Invalid amount'
+    END;
+
+    -- Security: only existing payments and invoices may be referenced
+    UPDATE {STAGING_TABLE} s SET invoice_id = i.id
+    FROM (
+        SELECT DISTINCT ON (name) name, id FROM {INVOICE_TABLE} ORDER BY name, id
+    ) i
+    WHERE s.error IS NULL AND i.name = s.invoice_name;
+    UPDATE {STAGING_TABLE} s SET error = 'Unknown invoice' WHERE s.error IS NULL AND s.invoice_id IS NULL;
+    UPDATE {STAGING_TABLE} s SET error = 'Unknown payment'
+    WHERE s.error IS NULL AND NOT EXISTS (SELECT 1 FROM {PAYMENT_TABLE} p WHERE p.id = s.payment_id);
+
+    -- Later rows for the same payment win, as in the row-by-row import
+    UPDATE {STAGING_TABLE} s SET error = 'Superseded'
+    WHERE s.error IS NULL AND EXISTS (
+        SELECT 1 FROM {STAGING_TABLE} later
+        WHERE later.error IS NULL AND later.payment_id = s.payment_id AND later.line_no > s.line_no
+    );
+
+    -- Keep the (invoice, due_month) constraint: the target month must not
+    -- belong to another payment or be claimed by an earlier row
+    UPDATE {STAGING_TABLE} s SET error = 'Month already used'
+    WHERE s.error IS NULL AND (
+        EXISTS (
+            SELECT 1 FROM {PAYMENT_TABLE} p
+            WHERE p.invoice_id = s.invoice_id
+              AND p.due_month = date_trunc('month', s.due_date)::date
+              AND p.id <> s.payment_id
+        )
+        OR EXISTS (
+            SELECT 1 FROM {STAGING_TABLE} other
+            WHERE other.error IS NULL
+              AND other.invoice_id = s.invoice_id
+              AND date_trunc('month', other.due_date) = date_trunc('month', s.due_date)
+              AND other.payment_id <> s.payment_id
+              AND other.line_no < s.line_no
+        )
+    )
+"""
+
+# Lock the payments named in the file, so the old values COUNTERS_SQL and
+# SUMMARY_SQL subtract are still the ones MERGE_SQL overwrites
+LOCK_SQL = f"""
+    SELECT p.id FROM {PAYMENT_TABLE} p
+    WHERE p.id IN (SELECT payment_id FROM {STAGING_TABLE} WHERE payment_id IS NOT NULL)
+    ORDER BY p.id
+    FOR UPDATE
+"""
+
+
+def _changed_rows(join=''):
+    """FROM clause of the staged rows that differ from their payment, i.e. the rows MERGE_SQL writes"""
+    return f"""
+    FROM {STAGING_TABLE} s
+    JOIN {PAYMENT_TABLE} p ON p.id = s.payment_id
+    {join}
+    WHERE s.error IS NULL
+      AND (p.invoice_id, p.due_date, p.processed_date, p.amount_received, p.is_deducted, p.processed)
+          IS DISTINCT FROM
+          (s.invoice_id, s.due_date, s.processed_date, s.amount_received, s.is_deducted, s.processed)
+    """
+
+
+# Same rules as processpay.ledger; COUNTERS_SQL and SUMMARY_SQL must run
+# before MERGE_SQL, while the payments still hold their old values
+COUNTERS_SQL = f"""
+    UPDATE {INVOICE_TABLE} i SET
+        processed_count = i.processed_count + d.processed_count,
+        received_total = i.received_total + d.received_total,
+        deducted_total = i.deducted_total + d.deducted_total,
+        pending_count = i.pending_count + d.pending_count
+    FROM (
+        SELECT invoice_id,
+               sum(sign * processed::int) AS processed_count,
+               sum(CASE WHEN processed AND NOT is_deducted THEN sign * amount_received ELSE 0 END) AS received_total,
+               sum(CASE WHEN is_deducted THEN sign * amount_received ELSE 0 END) AS deducted_total,
+               sum(sign * (NOT processed)::int) AS pending_count
+        FROM (
+            SELECT p.invoice_id, p.processed, p.is_deducted, p.amount_received, -1 AS sign {_changed_rows()}
+            UNION ALL
+            SELECT s.invoice_id, s.processed, s.is_deducted, s.amount_received, 1 AS sign {_changed_rows()}
+        ) changes
+        GROUP BY invoice_id
+    ) d
+    WHERE i.id = d.invoice_id
+"""
+
+SUMMARY_TABLE = MonthlySummary._meta.db_table
+
+# MonthlySummary side of COUNTERS_SQL
+SUMMARY_SQL = f"""
+    INSERT INTO {SUMMARY_TABLE} AS m (month, payment_count, pending_count, due_amount, pending_amount,
+                                      processed_amount, received_amount, deducted_amount)
+    SELECT due_month,
+           sum(sign),
+           sum(sign * (NOT processed)::int),
+           sum(sign * monthly_amount),
+           sum(CASE WHEN NOT processed THEN sign * monthly_amount ELSE 0 END),
+           sum(CASE WHEN processed THEN sign * amount_received ELSE 0 END),
+           sum(CASE WHEN processed AND NOT is_deducted THEN sign * amount_received ELSE 0 END),
+           sum(CASE WHEN is_deducted THEN sign * amount_received ELSE 0 END)
+    FROM (
+        SELECT p.due_month, p.processed, p.is_deducted, p.amount_received, i.monthly_amount, -1 AS sign
+        {_changed_rows(f'JOIN {INVOICE_TABLE} i ON i.id = p.invoice_id')}
+        UNION ALL
+        SELECT date_trunc('month', s.due_date)::date, s.processed, s.is_deducted, s.amount_received, i.monthly_amount, 1 AS sign
+        {_changed_rows(f'JOIN {INVOICE_TABLE} i ON i.id = s.invoice_id')}
+    ) changes
+    GROUP BY due_month
+    ON CONFLICT (month) DO UPDATE SET
+        payment_count = m.payment_count + EXCLUDED.payment_count,
+        pending_count = m.pending_count + EXCLUDED.pending_count,
+        due_amount = m.due_amount + EXCLUDED.due_amount,
+        pending_amount = m.pending_amount + EXCLUDED.pending_amount,
+        processed_amount = m.processed_amount + EXCLUDED.processed_amount,
+        received_amount = m.received_amount + EXCLUDED.received_amount,
+        deducted_amount = m.deducted_amount + EXCLUDED.deducted_amount
+"""
+
+MERGE_SQL = f"""
+    UPDATE {PAYMENT_TABLE} p SET
+        invoice_id = s.invoice_id,
+        due_date = s.due_date,
+        due_month = date_trunc('month', s.due_date)::date,
+        processed_date = s.processed_date,
+        amount_received = s.amount_received,
+        is_deducted = s.is_deducted,
+        processed = s.processed
+    FROM {STAGING_TABLE} s
+    WHERE s.error IS NULL
+      AND p.id = s.payment_id
+      AND (p.invoice_id, p.due_date, p.processed_date, p.amount_received, p.is_deducted, p.processed)
+          IS DISTINCT FROM
+          (s.invoice_id, s.due_date, s.processed_date, s.amount_received, s.is_deducted, s.processed)
+"""
+
+
+def copy_import(reader, result):
+    """
+    Import the remaining rows of ``reader`` through a COPY staging table.
+
+    Fills and returns ``result``.
+    """
+    started = time.monotonic()
+    stream = _StagingStream(reader)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(CREATE_STAGING_SQL)
+        cursor.copy_expert(
+            f'COPY {STAGING_TABLE} (line_no, column_count, raw_id, raw_name, raw_due_date, '
+            f'raw_processed_date, raw_amount, raw_is_deducted, raw_processed) FROM STDIN WITH (FORMAT csv, '
+            f'FORCE_NOT_NULL (raw_id, raw_name, raw_due_date, raw_processed_date, raw_amount, raw_is_deducted, raw_processed))',
+            stream,
+        )
+        cursor.execute(f'ANALYZE {STAGING_TABLE}')
+        due_format, processed_format = map(detect_date_format, stream.date_samples)
+        cursor.execute(_validate_sql(due_format, processed_format))
+        cursor.execute(LOCK_SQL)
+        cursor.execute(CHECK_SQL)
+        cursor.execute(COUNTERS_SQL)
+        cursor.execute(SUMMARY_SQL)
+        cursor.execute(MERGE_SQL)
+        result.updated = cursor.rowcount
+        cursor.execute(
+            f"SELECT count(*) FILTER (WHERE error IS NULL), "
+            f"count(*) FILTER (WHERE error IS NOT NULL AND error <> 'Superseded') FROM {STAGING_TABLE}"
+        )
+        valid, errors = cursor.fetchone()
+
+    result.rows = stream.rows
+    result.unchanged = valid - result.updated
+    result.errors = errors
+    result.elapsed = time.monotonic() - started
+    return result
@@ -0,0 +1,15 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from addinvoice.models import Invoice
+from processpay.models import Payment
+from .cache import bump_ledger_version
+
+
+@receiver([post_save, post_delete], sender=Payment)
+def payment_changed(sender, instance, **kwargs):
+    bump_ledger_version([instance.invoice_id])
+
+
+@receiver([post_save, post_delete], sender=Invoice)
+def invoice_changed(sender, instance, **kwargs):
+    bump_ledger_version([instance.pk])
@@ -1,3 +1,754 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, transaction
+from django.test import TestCase, override_settings
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from addinvoice.models import Invoice
+from plantcon.middleware import QueryBudgetExceeded
+from processpay.ledger import COUNTER_FIELDS, rebuild_invoice_counters, rebuild_monthly_summary
+from processpay.generation import generate_pending_payments
+from processpay.locks import job_lock
+from processpay.models import Payment
+from processpay.processing import process_pending_payment, toggle_deducted
+from statement.cache import invoice_version
+from statement.checks import check_shared_cache
+from statement.importer import (
+    CSV_HEADER, DateColumn, InvalidCSVError, apply_changes, detect_date_format, import_payments, load_changes,
+    preview_payments,
+)
+from statement.jobs import (
+    claim_next_job, confirm_preview, discard_expired_previews, enqueue_import, fail_stale_jobs, run_job,
+)
+from statement.models import ImportJob, MonthlySummary
+from statement.views import _dashboard_metrics
+
+
+def _csv(*rows):
+    """Import file with the export header and ``rows``"""
+    return io.StringIO('\n'.join(','.join(map(str, row)) for row in [CSV_HEADER, *rows]) + '\n')
+
+
+class LedgerMixin:
+    def _ledger(self):
+        counters = list(Invoice.objects.order_by('pk').values_list(*COUNTER_FIELDS))
+        months = list(MonthlySummary.objects.exclude(payment_count=0).values_list(
+            'month', 'payment_count', 'pending_count', 'due_amount', 'pending_amount',
+            'processed_amount', 'received_amount', 'deducted_amount',
+        ))
+        return counters, months
+
+    def assertLedgerInStep(self):
+        ledger = self._ledger()
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+        self.assertEqual(ledger, self._ledger())
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class DashboardCacheTests(TestCase):
+    def setUp(self):
+        # The cache may not live in the test database
+        cache.clear()
+        self.user = get_user_model().objects.create_user('operator', password='secret')
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.invoice = Invoice.objects.create(
+                name='Cached',
+                start_date=date(2025, 1, 1),
+                end_date=date(2026, 1, 1),
+                monthly_amount=Decimal('100.00'),
+            )
+            self.payment = Payment.objects.create(invoice=self.invoice, due_date=date(2025, 1, 1))
+
+    def _stats(self):
+        stats = self.client.get(reverse('statement:dashboard_cache_stats')).json()
+        return stats['hits'], stats['misses']
+
+    def test_dashboard_is_cached_until_a_payment_changes(self):
+        hits, misses = self._stats()
+        self.client.get(reverse('statement:dashboard'))
+        self.client.get(reverse('statement:dashboard'))
+        self.assertEqual(self._stats(), (hits + 1, misses + 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('processpay:process_payment', args=[self.payment.pk]),
+                             {'amount_received': '100.00'})
+        response = self.client.get(reverse('statement:dashboard'))
+
+        self.assertEqual(self._stats(), (hits + 1, misses + 2))
+        self.assertEqual(response.context['total_paid'], Decimal('100.00'))
+
+
+class DashboardMetricsTests(TestCase):
+    def setUp(self):
+        self.today = date(2025, 3, 15)
+        for name, amount in (('Small', '100.00'), ('Large', '250.50')):
+            Invoice.objects.create(name=name, start_date=date(2025, 1, 10), end_date=date(2026, 1, 10),
+                                   monthly_amount=Decimal(amount))
+        generate_pending_payments(today=self.today)
+        payments = list(Payment.objects.order_by('pk'))
+        for payment, amount, is_deducted in zip(payments[::2], ('100.00', '80.25', '250.50'), (False, True, False)):
+            process_pending_payment(payment.pk, Decimal(amount), is_deducted, today=self.today)
+        toggle_deducted([payments[1].pk, payments[4].pk])
+
+    def test_metrics_match_the_payment_queries(self):
+        def total(queryset, field):
+            return queryset.aggregate(total=Sum(field))['total'] or 0
+
+        pending = Payment.objects.filter(processed=False)
+        expected = {
+            'pending_payments_count': pending.count(),
+            'total_paid': total(Payment.objects.filter(processed=True, is_deducted=False), 'amount_received'),
+            'pending_this_month_amount': total(pending.filter(due_date__year=2025, due_date__month=3),
+                                               'invoice__monthly_amount'),
+            'total_deducted': total(Payment.objects.filter(is_deducted=True), 'amount_received'),
+        }
+
+        with self.assertNumQueries(1):
+            metrics = _dashboard_metrics(self.today)
+
+        self.assertEqual(metrics, expected)
+        self.assertEqual(metrics, {
+            'pending_payments_count': 3,
+            'total_paid': Decimal('100.00'),
+            'pending_this_month_amount': Decimal('250.50'),
+            'total_deducted': Decimal('330.75'),
+        })
+
+
+class SharedCacheCheckTests(TestCase):
+    def test_per_process_cache_is_an_error(self):
+        self.assertEqual(check_shared_cache(None), [])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['statement.E001'])
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class ToggleDeductedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('operator', password='secret')
+        self.client.force_login(self.user)
+        self.invoice = Invoice.objects.create(
+            name='Toggled',
+            start_date=date(2025, 1, 1),
+            end_date=date(2026, 1, 1),
+            monthly_amount=Decimal('100.00'),
+        )
+        self.payments = [
+            Payment.objects.create(invoice=self.invoice, due_date=date(2025, month, 1), processed=True,
+                                   amount_received=Decimal('100.00'))
+            for month in (1, 2, 3)
+        ]
+        rebuild_invoice_counters()
+
+    def _counters(self):
+        self.invoice.refresh_from_db()
+        return [getattr(self.invoice, name) for name in COUNTER_FIELDS]
+
+    def test_toggle_returns_new_state_and_totals(self):
+        url = reverse('statement:toggle_deducted', args=[self.payments[0].pk])
+        self.assertEqual(self.client.get(url).status_code, 405)
+
+        data = self.client.post(url).json()
+
+        self.assertEqual((data['is_deducted'], data['totals']['deducted_total']), (True, '100.00'))
+        self.assertEqual(data['totals']['received_total'], '200.00')
+
+    def test_bulk_toggle_keeps_counters_in_step(self):
+        response = self.client.post(
+            reverse('statement:bulk_toggle_deducted'),
+            json.dumps({'payments': [self.payments[0].pk, self.payments[1].pk]}),
+            content_type='application/json',
+        )
+        self.assertEqual([p['is_deducted'] for p in response.json()['payments']], [True, True])
+        self.client.post(reverse('statement:toggle_deducted', args=[self.payments[1].pk]))
+
+        counters = self._counters()
+        rebuild_invoice_counters()
+        self.assertEqual(counters, self._counters())
+        self.assertEqual(counters, [3, Decimal('200.00'), Decimal('100.00'), 0])
+
+
+@override_settings(QUERY_BUDGET_STRICT=True)
+class InvoiceDetailTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('operator', password='secret')
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.invoice, self.other = [
+                Invoice.objects.create(
+                    name=name,
+                    start_date=date(2025, 1, 1),
+                    end_date=date(2026, 1, 1),
+                    monthly_amount=Decimal('100.00'),
+                )
+                for name in ('Shown', 'Other')
+            ]
+            for invoice in (self.invoice, self.other):
+                for month in range(1, 6):
+                    Payment.objects.create(invoice=invoice, due_date=date(2025, month, 1))
+
+    def _history(self, **params):
+        response = self.client.get(reverse('statement:invoice_detail', args=[self.invoice.pk]), params)
+        return response, [tr for tr in response.content.decode().split('<tr class="payment"')[1:]]
+
+    @override_settings(INVOICE_PAYMENTS_PAGE_SIZE=3)
+    def test_history_pages_follow_the_cursor(self):
+        response, rows = self._history()
+        self.assertEqual(len(rows), 3)
+        last = self.invoice.payments.order_by('due_date', 'id')[2]
+        self.assertContains(response, f'after={last.due_date}.{last.pk}')
+
+        _, rows = self._history(after=f'{last.due_date}.{last.pk}')
+        self.assertEqual(len(rows), 2)
+
+    def _history_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            self._history()
+        return [q['sql'] for q in context.captured_queries if Payment._meta.db_table in q['sql']]
+
+    def test_history_is_cached_until_the_invoice_changes(self):
+        self.assertTrue(self._history_queries())
+        self.assertEqual(self._history_queries(), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('statement:toggle_deducted', args=[self.other.payments.first().pk]))
+        self.assertEqual(self._history_queries(), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('statement:toggle_deducted', args=[self.invoice.payments.first().pk]))
+        self.assertTrue(self._history_queries())
+        _, rows = self._history()
+        self.assertIn('Mark as Not Deducted', rows[0])
+
+    @override_settings(CACHES={
+        **settings.CACHES,
+        'template_fragments': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    })
+    def test_history_is_cached_with_the_shared_versions(self):
+        self._history()
+
+        key = make_template_fragment_key(
+            'invoice_history', [self.invoice.pk, invoice_version(self.invoice.pk), ''])
+        self.assertIsNotNone(caches['default'].get(key))
+        self.assertIsNone(caches['template_fragments'].get(key))
+
+
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('operator', password='secret')
+        self.client.force_login(self.user)
+
+    @override_settings(QUERY_BUDGETS={'statement:dashboard': 1}, QUERY_BUDGET_STRICT=False)
+    def test_over_budget_view_logs_a_warning(self):
+        with self.assertLogs('plantcon.queries', 'WARNING') as logs:
+            self.client.get(reverse('statement:dashboard'))
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['view'], record['budget']), ('statement:dashboard', 1))
+        self.assertGreater(record['queries'], 1)
+        self.assertEqual(len(record['slowest']), 3)
+
+    def test_requests_within_budget_log_at_debug(self):
+        with self.assertLogs('plantcon.queries', 'DEBUG') as logs:
+            self.client.get(reverse('statement:dashboard'))
+
+        self.assertEqual([record.levelname for record in logs.records], ['DEBUG'])
+
+    @override_settings(QUERY_BUDGETS={'statement:dashboard': 1}, QUERY_BUDGET_STRICT=True)
+    def test_over_budget_view_raises_when_strict(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get(reverse('statement:dashboard'))
+
+
+class ImportJobQueueTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        lock_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(lock_dir.cleanup)
+        self.enterContext(override_settings(JOB_LOCK_DIR=lock_dir.name))
+        self.user = get_user_model().objects.create_user('operator', password='secret')
+
+    def _enqueue(self, content='Payment ID,Amount Received\n'):
+        return enqueue_import(SimpleUploadedFile('payments.csv', content.encode()), self.user)
+
+    def _payment(self):
+        invoice = Invoice.objects.create(
+            name='Queued',
+            start_date=date(2025, 1, 1),
+            end_date=date(2026, 1, 1),
+            monthly_amount=Decimal('100.00'),
+        )
+        return Payment.objects.create(invoice=invoice, due_date=date(2025, 1, 1))
+
+    def test_jobs_are_claimed_oldest_first_and_once(self):
+        first, second = self._enqueue(), self._enqueue()
+
+        self.assertEqual(claim_next_job().pk, first.pk)
+        self.assertEqual(claim_next_job().pk, second.pk)
+        self.assertIsNone(claim_next_job())
+
+    @override_settings(IMPORT_JOB_STALE_AFTER=60)
+    def test_stale_running_jobs_are_failed(self):
+        stale, busy = self._enqueue(), self._enqueue()
+        claim_next_job(), claim_next_job()
+        ImportJob.objects.filter(pk=stale.pk).update(heartbeat_at=timezone.now() - timedelta(minutes=5))
+
+        self.assertIsNone(claim_next_job())
+
+        stale.refresh_from_db()
+        busy.refresh_from_db()
+        self.assertEqual((stale.status, busy.status), (ImportJob.STATUS_FAILED, ImportJob.STATUS_RUNNING))
+        self.assertIsNotNone(stale.finished_at)
+
+    @override_settings(IMPORT_JOB_STALE_AFTER=60)
+    def test_jobs_whose_worker_holds_the_lock_are_not_failed(self):
+        job = self._enqueue()
+        claim_next_job()
+        ImportJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(minutes=5))
+        taken, release = threading.Event(), threading.Event()
+
+        def worker():
+            # A worker busy in one long statement, with its own connection
+            try:
+                with job_lock(f'import_job_{job.pk}'):
+                    taken.set()
+                    release.wait()
+            finally:
+                taken.set()
+                connections.close_all()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        try:
+            taken.wait()
+            self.assertEqual(fail_stale_jobs(), 0)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(fail_stale_jobs(), 1)
+
+    def test_run_job_records_progress(self):
+        payment = self._payment()
+        content = _csv((payment.pk, 'Queued', '2025-01-01', '2025-01-03', '100.00', 'False', 'True'),
+                       (999999, 'Queued', '2025-01-01', '', '', 'False', 'False'))
+        upload = self._enqueue(content.getvalue()).csv_file.path
+
+        job = run_job(claim_next_job())
+
+        self.assertEqual(job.status, ImportJob.STATUS_DONE)
+        self.assertEqual((job.rows_processed, job.updated_count, job.error_count), (2, 1, 1))
+        self.assertIsNotNone(job.heartbeat_at)
+        self.assertFalse(job.csv_file)
+        self.assertFalse(os.path.exists(upload))
+        payment.refresh_from_db()
+        self.assertTrue(payment.processed)
+
+        self.client.force_login(self.user)
+        status = self.client.get(reverse('statement:import_job_status', args=[job.pk])).json()
+        self.assertEqual((status['status'], status['updated'], status['errors'], status['finished']),
+                         ('done', 1, 1, True))
+
+    def test_run_job_records_failures(self):
+        self._enqueue('not,a,payments,file\n')
+
+        job = run_job(claim_next_job())
+
+        self.assertEqual(job.status, ImportJob.STATUS_FAILED)
+        self.assertIn('Invalid CSV format', job.message)
+        self.assertIsNotNone(job.finished_at)
+        self.assertFalse(job.csv_file)
+
+
+class PaymentExportTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('operator', password='secret')
+        self.client.force_login(self.user)
+        invoice = Invoice.objects.create(
+            name='Exported, "quoted"',
+            start_date=date(2025, 1, 1),
+            end_date=date(2026, 1, 1),
+            monthly_amount=Decimal('100.00'),
+        )
+        Payment.objects.create(invoice=invoice, due_date=date(2025, 1, 1), processed=True,
+                               processed_date=date(2025, 1, 3), amount_received=Decimal('100.00'))
+        Payment.objects.create(invoice=invoice, due_date=date(2025, 2, 1), is_deducted=True)
+
+    def _export(self):
+        response = self.client.get(reverse('statement:export_payments_csv'))
+        return b''.join(response.streaming_content)
+
+    def test_export_lines_end_in_lf(self):
+        with override_settings(PAYMENT_CSV_USE_COPY=False):
+            content = self._export()
+        self.assertNotIn(b'\r', content)
+        self.assertEqual(len(content.splitlines()), 3)
+
+    @skipUnless(connection.vendor == 'postgresql', 'COPY needs PostgreSQL')
+    def test_copy_export_matches_orm_export(self):
+        with override_settings(PAYMENT_CSV_USE_COPY=False):
+            orm = self._export()
+        with override_settings(PAYMENT_CSV_USE_COPY=True):
+            copy = self._export()
+        self.assertEqual(copy, orm)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'COPY needs PostgreSQL')
+class CopyImportTests(LedgerMixin, TestCase):
+    def setUp(self):
+        invoice, other, _ = [
+            Invoice.objects.create(
+                name=name,
+                start_date=date(2025, 1, 1),
+                end_date=date(2026, 1, 1),
+                monthly_amount=Decimal('100.00'),
+            )
+            for name in ('Copied', 'Other, "quoted"', 'Copied')
+        ]
+        self.ids = [
+            Payment.objects.create(invoice=owner, due_date=date(2025, month, 1)).pk
+            for owner in (invoice, other) for month in range(1, 6)
+        ]
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+
+    def _import(self, use_copy, content):
+        with transaction.atomic():
+            with override_settings(PAYMENT_CSV_USE_COPY=use_copy):
+                result = import_payments(io.StringIO(content))
+            state = list(Payment.objects.order_by('pk').values_list(
+                'invoice__name', 'due_date', 'processed_date', 'amount_received', 'is_deducted', 'processed',
+            ))
+            outcome = (result.rows, result.updated, result.unchanged, result.errors), state, self._ledger()
+            self.assertLedgerInStep()
+            transaction.set_rollback(True)
+        return outcome
+
+    def test_copy_import_matches_orm_import(self):
+        ids = self.ids
+        content = '\n'.join([
+            ','.join(CSV_HEADER),
+            f'{ids[0]},Copied,2025-01-15,2025-01-20,100.5,False,True',
+            f'{ids[1]}, Copied ,2025-02-03,,1e2,yes,on',
+            f'{ids[2]},Copied,2025-03-01,,0,no,false',
+            f'{ids[3]},Copied,2025-02-30,,0,no,false',
+            f'{ids[4]},Copied,2025-05-01,,abc,no,false',
+            f'{ids[5]},"Other, ""quoted""",2025-06-01,,-1,no,false',
+            f'{ids[6]},Missing,2025-06-01,,1,no,false',
+            '999999,Copied,2025-06-01,,1,no,false',
+            f'{ids[7]},"Other, ""quoted""",2025-01-09,,,t,1',
+            f'{ids[8]},"Other, ""quoted""",2025-09-09,,,t,1',
+            f'{ids[8]},"Other, ""quoted""",2025-10-09,,,t,1',
+            f'{ids[9]},"Other, ""quoted""",2025-05-01',
+            'x,Copied,2025-06-01,,1,no,false',
+            f'{ids[9]},Copied,2025-05-01,,2.346,1,1,extra',
+        ]) + '\n'
+
+        orm = self._import(False, content)
+        self.assertEqual(self._import(True, content), orm)
+        self.assertEqual(orm[0], (14, 3, 1, 9))
+
+
+@override_settings(PAYMENT_CSV_USE_COPY=False)
+class PaymentImportTests(LedgerMixin, TestCase):
+    def setUp(self):
+        self.invoice, self.other = [
+            Invoice.objects.create(
+                name=name,
+                start_date=date(2025, 1, 1),
+                end_date=date(2026, 1, 1),
+                monthly_amount=Decimal('100.00'),
+            )
+            for name in ('Imported', 'Other')
+        ]
+        self.payments = [
+            Payment.objects.create(invoice=self.invoice, due_date=date(2025, month, 1)) for month in (1, 2, 3)
+        ]
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+
+    def _row(self, payment, invoice='Imported', due_date=None, amount='', is_deducted='False', processed='False',
+             processed_date=''):
+        due_date = due_date or payment.due_date.isoformat()
+        return (payment.pk, invoice, due_date, processed_date, amount, is_deducted, processed)
+
+    def test_only_changed_payments_are_written(self):
+        first, second, third = self.payments
+        result = import_payments(_csv(
+            self._row(first, amount='100.00', processed='True', processed_date='2025-01-05'),
+            self._row(second),
+            self._row(third, invoice='Other', is_deducted='yes'),
+        ))
+
+        self.assertEqual((result.rows, result.updated, result.unchanged, result.errors), (3, 2, 1, 0))
+        first.refresh_from_db()
+        self.assertEqual((first.processed, first.amount_received), (True, Decimal('100.00')))
+        self.assertEqual(Payment.objects.get(pk=third.pk).invoice, self.other)
+        self.assertLedgerInStep()
+
+    def test_query_count_does_not_grow_with_rows(self):
+        def queries(payments):
+            with CaptureQueriesContext(connection) as context:
+                import_payments(_csv(*[self._row(payment, amount='5.00') for payment in payments]))
+            return len(context)
+
+        self.assertEqual(queries(self.payments[:1]), queries(self.payments[1:]))
+
+    def test_wrong_header_rejects_the_file(self):
+        for content in ('', 'Payment ID,Amount\n1,2\n'):
+            with self.assertRaises(InvalidCSVError):
+                import_payments(io.StringIO(content))
+
+    def test_invalid_rows_and_unknown_references_are_skipped(self):
+        first, second, third = self.payments
+        result = import_payments(_csv(
+            self._row(first, amount='abc'),
+            self._row(first, due_date='2025-02-30'),
+            (second.pk, 'Imported', '2025-02-01'),
+            (999999, 'Imported', '2025-02-01', '', '', 'False', 'False'),
+            self._row(second, invoice='Missing', amount='1.00'),
+            self._row(third, amount='3.00'),
+        ))
+
+        self.assertEqual((result.rows, result.updated, result.errors), (6, 1, 5))
+        self.assertEqual(list(Payment.objects.filter(amount_received__gt=0).values_list('pk', flat=True)), [third.pk])
+
+    def test_moves_onto_a_taken_month_are_rejected(self):
+        first, second, third = self.payments
+        result = import_payments(_csv(
+            self._row(first, due_date='2025-02-15'),
+            self._row(second, due_date='2025-04-01'),
+            self._row(third, due_date='2025-04-10'),
+        ))
+
+        self.assertEqual((result.updated, result.errors), (1, 2))
+        self.assertEqual(
+            list(Payment.objects.order_by('pk').values_list('due_date', flat=True)),
+            [date(2025, 1, 1), date(2025, 4, 1), date(2025, 3, 1)],
+        )
+        self.assertLedgerInStep()
+
+
+@override_settings(PAYMENT_CSV_USE_COPY=False)
+class StreamingImportTests(TestCase):
+    def setUp(self):
+        self.invoice = Invoice.objects.create(
+            name='Streamed',
+            start_date=date(2025, 1, 1),
+            end_date=date(2026, 1, 1),
+            monthly_amount=Decimal('100.00'),
+        )
+        self.payments = [
+            Payment.objects.create(invoice=self.invoice, due_date=date(2025, month, 1)) for month in range(1, 6)
+        ]
+
+    def test_file_is_read_one_batch_at_a_time(self):
+        lines = _csv(*[
+            (payment.pk, 'Streamed', payment.due_date, '', '10.00', 'False', 'False') for payment in self.payments
+        ]).readlines()
+        read = []
+
+        def stream():
+            for line in lines:
+                read.append(line)
+                yield line
+
+        progress = []
+        result = import_payments(stream(), batch_size=2,
+                                 on_batch=lambda result: progress.append((result.rows, len(read))))
+
+        # The header and each batch are read just before they are applied
+        self.assertEqual(progress, [(2, 3), (4, 5), (5, 6)])
+        self.assertEqual(result.updated, 5)
+
+    def test_upload_size_limit_is_a_setting(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.client.force_login(get_user_model().objects.create_user('operator', password='secret'))
+
+        for limit in (10, 11):
+            with override_settings(PAYMENT_IMPORT_MAX_UPLOAD_SIZE=limit, MEDIA_ROOT=media_root.name):
+                upload = SimpleUploadedFile('payments.csv', b'x' * 11)
+                self.client.post(reverse('statement:import_payments_csv'), {'csv_file': upload})
+
+        self.assertEqual(ImportJob.objects.count(), 1)
+
+
+class DateDetectionTests(TestCase):
+    def test_format_that_parses_most_samples_wins(self):
+        self.assertEqual(detect_date_format(['2025-01-31', '2025-1-5']), '%Y-%m-%d')
+        self.assertEqual(detect_date_format(['01/31/2025', '02/01/2025']), '%m/%d/%Y')
+        self.assertEqual(detect_date_format(['02/01/2025', '31/01/2025']), '%d/%m/%Y')
+        self.assertEqual(detect_date_format(['31/01/2025', '13/02/2025', '02/14/2025']), '%d/%m/%Y')
+        self.assertIsNone(detect_date_format([]))
+
+    def test_ambiguous_dates_prefer_month_first(self):
+        self.assertEqual(detect_date_format(['02/03/2025']), '%m/%d/%Y')
+
+    def test_detected_format_is_enforced_for_the_column(self):
+        column = DateColumn('due_date')
+        column.detect(['', '31/01/2025'])
+        column.detect(['2025-01-31'])
+
+        self.assertEqual(column('05/02/2025'), date(2025, 2, 5))
+        self.assertIsNone(column(''))
+        for value in ('2025-02-05', '31/13/2025', '5/2/25'):
+            with self.assertRaises(ValidationError):
+                column(value)
+
+    @override_settings(PAYMENT_CSV_USE_COPY=False)
+    def test_import_parses_day_first_files(self):
+        invoice = Invoice.objects.create(
+            name='Dated',
+            start_date=date(2025, 1, 1),
+            end_date=date(2026, 1, 1),
+            monthly_amount=Decimal('100.00'),
+        )
+        payments = [Payment.objects.create(invoice=invoice, due_date=date(2025, month, 1)) for month in (1, 2, 3)]
+
+        result = import_payments(_csv(
+            (payments[0].pk, 'Dated', '15/01/2025', '20/01/2025', '100.00', 'False', 'True'),
+            (payments[1].pk, 'Dated', '2025-02-15', '', '', 'False', 'False'),
+            (payments[2].pk, 'Dated', '15/03/2025', '', '', 'False', 'False'),
+        ))
+
+        # The ISO date does not match the file's day-first format
+        self.assertEqual((result.updated, result.errors), (2, 1))
+        payments[0].refresh_from_db()
+        self.assertEqual((payments[0].due_date, payments[0].processed_date), (date(2025, 1, 15), date(2025, 1, 20)))
+
+
+class ImportPreviewTests(LedgerMixin, TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        self.user = get_user_model().objects.create_user('operator', password='secret')
+        self.invoice, self.other = [
+            Invoice.objects.create(
+                name=name,
+                start_date=date(2025, 1, 1),
+                end_date=date(2026, 1, 1),
+                monthly_amount=Decimal('100.00'),
+            )
+            for name in ('Previewed', 'Other')
+        ]
+        self.payments = [
+            Payment.objects.create(invoice=self.invoice, due_date=date(2025, month, 1)) for month in (1, 2, 3)
+        ]
+        rebuild_invoice_counters()
+        rebuild_monthly_summary()
+
+    def _content(self):
+        first, second, third = self.payments
+        return _csv(
+            (first.pk, 'Previewed', '2025-01-01', '2025-01-03', '100.00', 'False', 'True'),
+            (second.pk, 'Other', '2025-02-01', '', '', 'False', 'False'),
+            (third.pk, 'Previewed', '2025-03-01', '', '', 'False', 'False'),
+            (999999, 'Previewed', '2025-03-01', '', '', 'False', 'False'),
+        )
+
+    def _state(self):
+        return list(Payment.objects.order_by('pk').values_list('invoice', 'amount_received', 'processed'))
+
+    def test_preview_reports_the_diff_without_writing(self):
+        before = self._state()
+
+        preview = preview_payments(self._content(), batch_size=2)
+
+        self.assertEqual(self._state(), before)
+        summary = preview.summary()
+        self.assertEqual((summary['changed'], summary['unchanged']), (2, 1))
+        self.assertEqual(summary['fields'], {'invoice': 1, 'processed_date': 1, 'amount_received': 1, 'processed': 1})
+        self.assertEqual(summary['reassignment_samples'], [(self.payments[1].pk, 'Previewed', 'Other')])
+        self.assertEqual(summary['unknown_payment_ids'], [999999])
+
+    def test_applied_preview_matches_a_direct_import(self):
+        changes = preview_payments(self._content()).changes
+        with transaction.atomic():
+            with override_settings(PAYMENT_CSV_USE_COPY=False):
+                import_payments(self._content())
+            imported = self._state()
+            transaction.set_rollback(True)
+
+        result = apply_changes(changes)
+
+        self.assertEqual((result.updated, result.errors), (2, 0))
+        self.assertEqual(self._state(), imported)
+        self.assertLedgerInStep()
+
+    def test_payments_edited_after_the_preview_are_skipped(self):
+        changes = preview_payments(self._content()).changes
+        Payment.objects.filter(pk=self.payments[0].pk).update(is_deducted=True)
+
+        result = apply_changes(changes)
+
+        self.assertEqual((result.updated, result.errors), (1, 1))
+        self.assertFalse(Payment.objects.get(pk=self.payments[0].pk).processed)
+        self.assertEqual(Payment.objects.get(pk=self.payments[1].pk).invoice, self.other)
+
+    def _preview_job(self):
+        upload = SimpleUploadedFile('payments.csv', self._content().getvalue().encode())
+        enqueue_import(upload, self.user, dry_run=True)
+        return run_job(claim_next_job())
+
+    def test_confirmed_preview_applies_its_stored_diff_once(self):
+        job = self._preview_job()
+        self.assertTrue(job.can_apply())
+        self.assertFalse(Payment.objects.filter(processed=True).exists())
+
+        self.assertTrue(confirm_preview(job))
+        self.assertFalse(confirm_preview(job))
+        job = run_job(claim_next_job())
+
+        self.assertEqual((job.status, job.updated_count), (ImportJob.STATUS_DONE, 2))
+        self.assertIsNone(job.diff)
+        self.assertTrue(Payment.objects.get(pk=self.payments[0].pk).processed)
+
+    def test_apply_that_failed_part_way_can_be_run_again(self):
+        job = self._preview_job()
+        self.assertTrue(confirm_preview(job))
+        # The worker wrote the changes, then died before finishing the job
+        apply_changes(load_changes(ImportJob.objects.get(pk=job.pk).diff))
+        ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.STATUS_FAILED, finished_at=timezone.now())
+        job.refresh_from_db()
+
+        self.assertTrue(job.can_apply())
+        self.assertTrue(confirm_preview(job))
+        job = run_job(claim_next_job())
+
+        self.assertEqual(job.status, ImportJob.STATUS_DONE)
+        self.assertEqual((job.updated_count, job.unchanged_count, job.error_count), (0, 2, 0))
+        self.assertLedgerInStep()
+
+    @override_settings(PAYMENT_IMPORT_PREVIEW_TIMEOUT=60)
+    def test_expired_previews_cannot_be_applied(self):
+        job = self._preview_job()
+        ImportJob.objects.filter(pk=job.pk).update(finished_at=timezone.now() - timedelta(minutes=5))
+
+        self.assertFalse(confirm_preview(job))
+        self.assertEqual(discard_expired_previews(), 1)
+        job.refresh_from_db()
+        self.assertFalse(job.can_apply())
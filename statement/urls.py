@@ -5,8 +5,12 @@ app_name = 'statement'
 
 urlpatterns = [
     path('dashboard/', views.dashboard, name='dashboard'),
+    path('dashboard/cache-stats/', views.dashboard_cache_stats, name='dashboard_cache_stats'),
     path('invoice/<int:invoice_id>/', views.invoice_detail, name='invoice_detail'),
-    path('payment/toggle_deducted/<int:payment_id>/', views.toggle_deducted, name='toggle_deducted'),
+    path('payment/toggle_deducted/<int:payment_id>/', views.toggle_deducted_payment, name='toggle_deducted'),
+    path('payment/toggle_deducted/', views.bulk_toggle_deducted, name='bulk_toggle_deducted'),
     path('export/csv/', views.export_payments_csv, name='export_payments_csv'),
     path('import/csv/', views.import_payments_csv, name='import_payments_csv'),
+    path('import/jobs/<int:job_id>/', views.import_job_status, name='import_job_status'),
+    path('import/jobs/<int:job_id>/apply/', views.apply_import_preview, name='apply_import_preview'),
 ]
\ No newline at end of file
@@ -1,66 +1,90 @@
 import csv
-import io
-from decimal import Decimal, InvalidOperation
-from django.http import HttpResponse
+import json
+from django.conf import settings
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_POST
 from django.contrib import messages
-from django.core.exceptions import ValidationError
+from django.template.defaultfilters import filesizeformat
+from django.utils.functional import SimpleLazyObject
 from addinvoice.models import Invoice
 from processpay.models import Payment
-from django.db.models import Sum
-from datetime import date, datetime
+from processpay.months import month_start
+from processpay.pagination import payment_page
+from processpay.processing import toggle_deducted
+from .cache import cache_stats, cached_ledger_data, invoice_version
+from .importer import CSV_HEADER
+from .jobs import confirm_preview, enqueue_import
+from .pgcopy import copy_enabled, copy_export_lines
+from .models import ImportJob, MonthlySummary
+from django.db.models import Q, Sum
+from datetime import date
+
+def _dashboard_metrics(today=None):
+    """Compute the dashboard payment metrics from the monthly summary table"""
+    today = today or date.today()
+    totals = MonthlySummary.objects.aggregate(
+        pending_payments_count=Sum('pending_count'),
+        total_paid=Sum('received_amount'),
+        pending_this_month_amount=Sum('pending_amount', filter=Q(month=month_start(today))),
+        total_deducted=Sum('deducted_amount'),
+    )
+    return {name: value or 0 for name, value in totals.items()}
+
+def _dashboard_data():
+    # Received totals are stored on each invoice (processpay.ledger)
+    return {
+        'invoices': list(Invoice.objects.order_by('id')),
+        **_dashboard_metrics(),
+    }
 
 @login_required
 def dashboard(request):
-    invoices = Invoice.objects.all()
-    
-    # Calculate dashboard metrics
-    pending_payments_count = Payment.objects.filter(processed=False).count()
-    total_paid = Payment.objects.filter(processed=True, is_deducted=False).aggregate(Sum('amount_received'))['amount_received__sum'] or 0
-    
-    today = date.today()
-    pending_this_month_amount = Payment.objects.filter(
-        processed=False,
-        due_date__year=today.year,
-        due_date__month=today.month
-    ).aggregate(Sum('invoice__monthly_amount'))['invoice__monthly_amount__sum'] or 0
-
-    total_deducted = Payment.objects.filter(is_deducted=True).aggregate(Sum('amount_received'))['amount_received__sum'] or 0
-
-    # Annotate invoices with total received amount
-    for invoice in invoices:
-        invoice.total_received_amount = invoice.payments.filter(processed=True, is_deducted=False).aggregate(Sum('amount_received'))['amount_received__sum'] or 0
-
+    # Cached until the next payment or invoice change (statement/cache.py)
     context = {
-        'invoices': invoices,
-        'pending_payments_count': pending_payments_count,
-        'total_paid': total_paid,
-        'pending_this_month_amount': pending_this_month_amount,
-        'total_deducted': total_deducted,
+        **cached_ledger_data(f'dashboard:{date.today()}', _dashboard_data),
+        'import_jobs': ImportJob.objects.order_by('-created_at')[:5],
     }
     return render(request, 'statement/dashboard.html', context)
 
 @login_required
-def export_payments_csv(request):
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="payments.csv"'
+def dashboard_cache_stats(request):
+    return JsonResponse(cache_stats())
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+class _Echo:
+    """Pseudo-buffer that returns each CSV line instead of storing it"""
+    def write(self, value):
+        return value
 
-    writer = csv.writer(response)
-    writer.writerow(['Payment ID', 'Invoice Name', 'Due Date', 'Processed Date', 'Amount Received', 'Is Deducted', 'Processed'])
-
-    payments = Payment.objects.all().select_related('invoice')
-    for payment in payments:
-        writer.writerow([
-            payment.id,
-            payment.invoice.name,
-            payment.due_date,
-            payment.processed_date,
-            payment.amount_received,
-            payment.is_deducted,
-            payment.processed,
-        ])
 
+def _export_csv_lines():
+    """Yield the export in blocks of EXPORT_CHUNK_SIZE rows"""
+    # LF like the COPY export, so both engines produce the same bytes
+    writer = csv.writer(_Echo(), lineterminator='\n')
+    yield writer.writerow(CSV_HEADER)
+
+    rows = Payment.objects.order_by('id').values_list(
+        'id', 'invoice__name', 'due_date', 'processed_date', 'amount_received', 'is_deducted', 'processed',
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    block = []
+    for row in rows:
+        block.append(writer.writerow(row))
+        if len(block) == EXPORT_CHUNK_SIZE:
+            yield ''.join(block)
+            block = []
+    if block:
+        yield ''.join(block)
+
+@login_required
+def export_payments_csv(request):
+    lines = copy_export_lines(CSV_HEADER) if copy_enabled() else _export_csv_lines()
+    response = StreamingHttpResponse(lines, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="payments.csv"'
     return response
 
 @login_required
@@ -75,164 +99,100 @@ def import_payments_csv(request):
             messages.error(request, 'This is not a CSV file.')
             return redirect('statement:dashboard')
 
-        # File size validation (max 5MB)
-        if csv_file.size > 5 * 1024 * 1024:
-            messages.error(request, 'File too large. Maximum size is 5MB.')
+        # File size validation
+        max_size = settings.PAYMENT_IMPORT_MAX_UPLOAD_SIZE
+        if csv_file.size > max_size:
+            messages.error(request, f'File too large. Maximum size is {filesizeformat(max_size)}.')
             return redirect('statement:dashboard')
 
-        try:
-            decoded_file = csv_file.read().decode('utf-8')
-            io_string = io.StringIO(decoded_file)
-            reader = csv.reader(io_string)
-            
-            # Verify header row
-            try:
-                header = next(reader)
-                expected_headers = ['Payment ID', 'Invoice Name', 'Due Date', 'Processed Date', 'Amount Received', 'Is Deducted', 'Processed']
-                if header != expected_headers:
-                    messages.error(request, 'Invalid CSV format. Please use the correct header format.')
-                    return redirect('statement:dashboard')
-            except StopIteration:
-                messages.error(request, 'Empty CSV file.')
-                return redirect('statement:dashboard')
-
-            updated_count = 0
-            error_count = 0
-            
-            for row_num, row in enumerate(reader, start=2):  # Start at 2 because of header
-                if len(row) < 7:
-                    error_count += 1
-                    continue
-                    
-                try:
-                    # Validate and sanitize input data
-                    payment_id = _validate_payment_id(row[0])
-                    invoice_name = _validate_invoice_name(row[1])
-                    due_date = _validate_date(row[2], 'due_date') if row[2] else None
-                    processed_date = _validate_date(row[3], 'processed_date') if row[3] else None
-                    amount_received = _validate_amount(row[4])
-                    is_deducted = _validate_boolean(row[5])
-                    processed = _validate_boolean(row[6])
-
-                    # Security: Only allow updates to existing payments, not arbitrary IDs
-                    try:
-                        existing_payment = Payment.objects.get(id=payment_id)
-                    except Payment.DoesNotExist:
-                        # Skip non-existent payments for security
-                        error_count += 1
-                        continue
-
-                    # Get or create invoice (but validate name)
-                    invoice, _ = Invoice.objects.get_or_create(
-                        name=invoice_name,
-                        defaults={'monthly_amount': Decimal('0.00')}
-                    )
-
-                    # Update only the existing payment
-                    existing_payment.invoice = invoice
-                    existing_payment.due_date = due_date
-                    existing_payment.processed_date = processed_date
-                    existing_payment.amount_received = amount_received
-                    existing_payment.is_deducted = is_deducted
-                    existing_payment.processed = processed
-                    existing_payment.save()
-                    
-                    updated_count += 1
-                    
-                except (ValidationError, ValueError, InvalidOperation) as e:
-                    error_count += 1
-                    continue
-                    
-            if updated_count > 0:
-                messages.success(request, f'CSV imported successfully. {updated_count} payments updated.')
-            if error_count > 0:
-                messages.warning(request, f'{error_count} rows had errors and were skipped.')
-                
-        except Exception as e:
-            messages.error(request, f'Error processing file: {str(e)[:100]}')  # Limit error message length
+        # The worker (`run_import_jobs`) does the import; progress shows on the dashboard
+        dry_run = 'dry_run' in request.POST
+        job = enqueue_import(csv_file, request.user, dry_run=dry_run)
+        if dry_run:
+            messages.info(request, f'Preview of {job.original_name} queued. Nothing is changed until you apply it.')
+        else:
+            messages.info(request, f'Import of {job.original_name} queued.')
 
     return redirect('statement:dashboard')
 
 
-def _validate_payment_id(value):
-    """Validate payment ID is a positive integer"""
-    try:
-        payment_id = int(value)
-        if payment_id <= 0:
-            raise ValidationError('Payment ID must be positive')
-        return payment_id
-    except (ValueError, TypeError):
-        raise ValidationError('Invalid payment ID')
-
-
-def _validate_invoice_name(value):
-    """Validate and sanitize invoice name"""
-    if not value or not isinstance(value, str):
-        raise ValidationError('Invoice name is required')
-    
-    # Sanitize: remove dangerous characters, limit length
-    sanitized = str(value).strip()[:200]
-    if not sanitized:
-        raise ValidationError('Invoice name cannot be empty')
-    
-    return sanitized
-
-
-def _validate_date(value, field_name):
-    """Validate date format"""
-    if not value:
-        return None
-        
-    try:
-        # Try multiple date formats
-        for fmt in ['%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y']:
-            try:
-                return datetime.strptime(value, fmt).date()
-            except ValueError:
-                continue
-        raise ValidationError(f'Invalid date format for {field_name}')
-    except Exception:
-        raise ValidationError(f'Invalid date for {field_name}')
-
-
-def _validate_amount(value):
-    """Validate monetary amount"""
-    if not value:
-        return Decimal('0.00')
-        
-    try:
-        amount = Decimal(str(value))
-        if amount < 0:
-            raise ValidationError('Amount cannot be negative')
-        if amount > Decimal('999999.99'):  # Reasonable upper limit
-            raise ValidationError('Amount too large')
-        return amount.quantize(Decimal('0.01'))  # Round to 2 decimal places
-    except (InvalidOperation, ValueError, TypeError):
-        raise ValidationError('Invalid amount format')
-
-
-def _validate_boolean(value):
-    """Validate boolean value"""
-    if isinstance(value, bool):
-        return value
-    if isinstance(value, str):
-        return value.lower() in ('true', '1', 't', 'yes', 'on')
-    return bool(value)
+@login_required
+def apply_import_preview(request, job_id):
+    job = get_object_or_404(ImportJob, pk=job_id)
+    if request.method == 'POST':
+        if confirm_preview(job):
+            messages.info(request, f'Changes from {job.original_name} queued.')
+        else:
+            messages.error(request, 'This preview can no longer be applied.')
+    return redirect('statement:dashboard')
 
 
+@login_required
+def import_job_status(request, job_id):
+    job = get_object_or_404(ImportJob, pk=job_id)
+    return JsonResponse({
+        'id': job.pk,
+        'file': job.original_name,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'rows_processed': job.rows_processed,
+        'updated': job.updated_count,
+        'unchanged': job.unchanged_count,
+        'errors': job.error_count,
+        'rows_per_second': round(job.rows_per_second(), 1),
+        'message': job.message,
+        'dry_run': job.dry_run,
+        'summary': job.summary,
+        'finished': job.status in (ImportJob.STATUS_DONE, ImportJob.STATUS_FAILED),
+    })
+
 @login_required
 def invoice_detail(request, invoice_id):
+    # The summary comes from the invoice's counters (processpay.ledger)
     invoice = get_object_or_404(Invoice, pk=invoice_id)
-    payments = invoice.payments.all().order_by('due_date')
+    cursor = request.GET.get('after')
     context = {
         'invoice': invoice,
-        'payments': payments,
+        # Only queried when the history fragment is not cached for this version
+        'page': SimpleLazyObject(lambda: payment_page(
+            invoice.payments.all(), cursor, settings.INVOICE_PAYMENTS_PAGE_SIZE)),
+        'cursor': cursor or '',
+        'invoice_version': invoice_version(invoice.pk),
+        'history_cache_timeout': settings.INVOICE_HISTORY_CACHE_TIMEOUT,
     }
     return render(request, 'statement/invoice_detail.html', context)
 
+def _toggle_response(payment_ids):
+    """JSON with the new state of the toggled payments and the totals of their invoices"""
+    toggled = toggle_deducted(payment_ids)
+    invoices = Invoice.objects.filter(pk__in={state[0] for state in toggled.values()}).values(
+        'id', 'received_total', 'deducted_total', 'processed_count', 'pending_count',
+    )
+    return {
+        'payments': [
+            {'id': pk, 'invoice': state[0], 'is_deducted': state[3], 'amount_received': state[4]}
+            for pk, state in toggled.items()
+        ],
+        'invoices': {invoice.pop('id'): invoice for invoice in invoices},
+    }
+
 @login_required
-def toggle_deducted(request, payment_id):
-    payment = get_object_or_404(Payment, pk=payment_id)
-    payment.is_deducted = not payment.is_deducted
-    payment.save()
-    return redirect('statement:invoice_detail', invoice_id=payment.invoice.id)
+@require_POST
+def toggle_deducted_payment(request, payment_id):
+    data = _toggle_response([payment_id])
+    if not data['payments']:
+        raise Http404('No Payment matches the given query.')
+    payment = data['payments'][0]
+    return JsonResponse({**payment, 'totals': data['invoices'][payment['invoice']]})
+
+@login_required
+@require_POST
+def bulk_toggle_deducted(request):
+    """Toggle the payments listed in a JSON body ``{"payments": [id, ...]}``"""
+    try:
+        payment_ids = json.loads(request.body)['payments']
+        if not isinstance(payment_ids, list) or not all(type(pk) is int for pk in payment_ids):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Expected a JSON object with a "payments" list of ids.'}, status=400)
+    return JsonResponse(_toggle_response(payment_ids))